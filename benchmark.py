@@ -0,0 +1,378 @@
+"""Benchmark offline do comparador visual com um site de fixtures local
+
+Sobe dois servidores http.server (produção e homologação) com páginas sintéticas:
+alturas diferentes, imagens com lazy loading, fonte que chega atrasada, layout shift
+injetado por script e diferenças de pixels conhecidas. Roda descoberta, captura e diff
+de ponta a ponta com BulkVisualComparator e registra páginas/minuto, latência por etapa
+e pico de memória do estágio de diff. O percentual de diferença de cada página é conferido
+contra o valor esperado, para que um ganho de velocidade não quebre a precisão.
+
+Uso:
+    python benchmark.py                       # roda e compara com o último resultado salvo
+    python benchmark.py --runs 3              # mediana de 3 execuções
+    python benchmark.py --baseline arquivo.json --fail-on-regression
+"""
+
+import argparse
+import functools
+import glob
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+from visual_diff import BulkVisualComparator
+
+
+# Largura da viewport do comparador; a altura dos screenshots é a altura da página
+PAGE_WIDTH = 1200
+VIEWPORT_HEIGHT = 800
+
+# Atraso (s) da resposta das fontes, para exercitar a espera por document.fonts
+FONT_DELAY = 1.5
+
+# Tolerância da precisão: diferença absoluta (pontos percentuais) entre esperado e medido
+ACCURACY_TOLERANCE = 0.1
+
+# Piora relativa (ex.: 0.15 = 15%) a partir da qual uma métrica conta como regressão
+REGRESSION_TOLERANCE = 0.15
+
+DEFAULT_OUTPUT_DIR = 'benchmark_results'
+
+FONT_SEARCH_PATTERNS = (
+    '/usr/share/fonts/**/*.ttf',
+    '/usr/local/share/fonts/**/*.ttf',
+    '/System/Library/Fonts/**/*.ttf',
+    '/Library/Fonts/**/*.ttf',
+    'C:/Windows/Fonts/*.ttf',
+)
+
+# Páginas do fixture. 'sections' define a altura total (seções de 400 px, sem margens),
+# então a diferença esperada sai direto da geometria das alterações em homologação.
+SECTION_HEIGHT = 400
+FIXTURE_PAGES = (
+    {'name': 'curta', 'sections': 2, 'kind': 'identical'},
+    {'name': 'media', 'sections': 8, 'kind': 'box', 'box': (100, 1300, 300, 200)},
+    {'name': 'alta', 'sections': 30, 'kind': 'box', 'box': (450, 9000, 600, 100)},
+    {'name': 'faixa-inserida', 'sections': 10, 'kind': 'inserted', 'band': 200},
+    {'name': 'lazy', 'sections': 10, 'kind': 'lazy', 'image': (300, 3250, 400, 300)},
+    {'name': 'fontes', 'sections': 4, 'kind': 'font'},
+    {'name': 'layout-shift', 'sections': 4, 'kind': 'shift'},
+)
+
+
+def expected_diff(spec):
+    """Percentual de diferença esperado para a página, a partir da geometria da alteração"""
+    height = max(spec['sections'] * SECTION_HEIGHT, VIEWPORT_HEIGHT)
+    if spec['kind'] == 'box':
+        _, _, w, h = spec['box']
+        return w * h / (PAGE_WIDTH * height) * 100
+    if spec['kind'] == 'lazy':
+        _, _, w, h = spec['image']
+        return w * h / (PAGE_WIDTH * height) * 100
+    if spec['kind'] == 'inserted':
+        # A faixa só existe em homologação: vira lacuna inteira depois do alinhamento de linhas
+        return spec['band'] / (height + spec['band']) * 100
+    return 0.0
+
+
+def page_html(spec, env, has_font):
+    """HTML de uma página do fixture para 'prod' ou 'hml'"""
+    head = ["<meta charset='utf-8'>", f"<title>{spec['name']}</title>",
+            "<style>body { margin: 0; font-family: sans-serif; background: #fff; }"
+            f" section {{ position: relative; height: {SECTION_HEIGHT}px; overflow: hidden; }}"
+            " h2 { margin: 0; padding: 20px; font-size: 28px; }"]
+    if spec['kind'] == 'font':
+        font_url = '/fonts/fixture.ttf' if has_font else '/fonts/ausente.ttf'
+        head.append(f"@font-face {{ font-family: 'Fixture'; src: url('{font_url}'); font-display: block; }}"
+                    " body { font-family: 'Fixture', sans-serif; }")
+    head.append("</style>")
+
+    body = []
+    for i in range(spec['sections']):
+        # Texto diferente em cada seção deixa as linhas distinguíveis para o alinhamento
+        content = f"<h2>{spec['name']} - seção {i + 1}</h2><p style='padding: 0 20px'>{'lorem ipsum ' * (i + 3)}</p>"
+        if spec['kind'] in ('box', 'lazy'):
+            x, y, w, h = spec['box'] if spec['kind'] == 'box' else spec['image']
+            if y // SECTION_HEIGHT == i:
+                top = y % SECTION_HEIGHT
+                if spec['kind'] == 'box' and env == 'hml':
+                    content += (f"<div style='position: absolute; left: {x}px; top: {top}px; "
+                                f"width: {w}px; height: {h}px; background: #000'></div>")
+                elif spec['kind'] == 'lazy':
+                    content += (f"<img src='/img/lazy_{env}.png' loading='lazy' width='{w}' height='{h}' "
+                                f"style='position: absolute; left: {x}px; top: {top}px'>")
+        body.append(f"<section>{content}</section>")
+        if spec['kind'] == 'inserted' and env == 'hml' and i == spec['sections'] // 2 - 1:
+            body.append(f"<div style='height: {spec['band']}px; background: #c00'></div>")
+
+    if spec['kind'] == 'shift':
+        # O banner entra depois do load e empurra a página inteira para baixo (nos dois ambientes)
+        body.append("<script>setTimeout(() => { const b = document.createElement('div');"
+                    " b.style.cssText = 'height: 150px; background: #fc0'; document.body.prepend(b); }, 400);"
+                    "</script>")
+    return f"<!DOCTYPE html><html><head>{''.join(head)}</head><body>{''.join(body)}</body></html>"
+
+
+def find_font(font_path=None):
+    if font_path:
+        return font_path
+    for pattern in FONT_SEARCH_PATTERNS:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        if matches:
+            return matches[0]
+    return None
+
+
+def build_fixture(root, font_path=None):
+    """Gera os diretórios prod/ e hml/ com as páginas, imagens, fonte, robots.txt e sitemap"""
+    font_path = find_font(font_path)
+    if not font_path:
+        print("⚠️  Nenhuma fonte .ttf encontrada: a página de fontes vai esperar por uma fonte ausente")
+
+    for env in ('prod', 'hml'):
+        env_dir = os.path.join(root, env)
+        os.makedirs(os.path.join(env_dir, 'img'), exist_ok=True)
+        os.makedirs(os.path.join(env_dir, 'fonts'), exist_ok=True)
+
+        links = ''.join(f"<li><a href='/{spec['name']}.html'>{spec['name']}</a></li>" for spec in FIXTURE_PAGES)
+        with open(os.path.join(env_dir, 'index.html'), 'w', encoding='utf-8') as f:
+            f.write(f"<!DOCTYPE html><html><head><meta charset='utf-8'><title>Fixture</title></head>"
+                    f"<body style='margin: 0'><h1>Fixture do benchmark</h1><ul>{links}</ul></body></html>")
+        for spec in FIXTURE_PAGES:
+            with open(os.path.join(env_dir, f"{spec['name']}.html"), 'w', encoding='utf-8') as f:
+                f.write(page_html(spec, env, font_path is not None))
+
+        # Imagem do lazy loading: azul na produção, vermelha em homologação (BGR)
+        lazy = next(spec for spec in FIXTURE_PAGES if spec['kind'] == 'lazy')
+        _, _, w, h = lazy['image']
+        color = (255, 0, 0) if env == 'prod' else (0, 0, 255)
+        cv2.imwrite(os.path.join(env_dir, 'img', f'lazy_{env}.png'), np.full((h, w, 3), color, dtype=np.uint8))
+
+        if font_path:
+            shutil.copyfile(font_path, os.path.join(env_dir, 'fonts', 'fixture.ttf'))
+    return font_path
+
+
+class FixtureHandler(SimpleHTTPRequestHandler):
+    """Serve o fixture; robots.txt e sitemap.xml usam o host da requisição e as fontes chegam atrasadas"""
+
+    def do_GET(self):
+        host = self.headers.get('Host', 'localhost')
+        if self.path == '/robots.txt':
+            return self._send_text(f"User-agent: *\nSitemap: http://{host}/sitemap.xml\n", 'text/plain')
+        if self.path == '/sitemap.xml':
+            urls = ''.join(f"<url><loc>http://{host}/{spec['name']}.html</loc></url>" for spec in FIXTURE_PAGES)
+            return self._send_text('<?xml version="1.0" encoding="UTF-8"?>'
+                                   '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+                                   f'<url><loc>http://{host}/</loc></url>{urls}</urlset>', 'application/xml')
+        if self.path.startswith('/fonts/'):
+            time.sleep(FONT_DELAY)
+        return super().do_GET()
+
+    def _send_text(self, text, content_type):
+        data = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(directory):
+    """Sobe um servidor HTTP numa porta livre em segundo plano; devolve (servidor, porta)"""
+    handler = functools.partial(FixtureHandler, directory=directory)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
+
+
+def check_accuracy(results):
+    """Confere o percentual de cada página do fixture com o esperado"""
+    by_page = {}
+    for result in results:
+        path = result['prod_url'].split('://', 1)[-1].split('/', 1)[-1]
+        by_page[path] = result
+
+    checks = []
+    for spec in FIXTURE_PAGES:
+        expected = expected_diff(spec)
+        result = by_page.get(f"{spec['name']}.html")
+        actual = result['diff_percentage'] if result else None
+        ok = actual is not None and abs(actual - expected) <= ACCURACY_TOLERANCE
+        checks.append({'page': spec['name'], 'kind': spec['kind'], 'expected': round(expected, 4),
+                       'actual': round(actual, 4) if actual is not None else None, 'ok': ok})
+    return checks
+
+
+def run_once(fixture_root, prod_port, hml_port, workers, diff_workers):
+    """Uma execução de ponta a ponta, sem caches, num diretório próprio"""
+    previous_dir = os.getcwd()
+    run_dir = tempfile.mkdtemp(prefix='run_', dir=fixture_root)
+    os.chdir(run_dir)
+    try:
+        # Sem cache de diff, de assets nem baselines: mede sempre o caminho completo
+        comparator = BulkVisualComparator(
+            f"http://127.0.0.1:{prod_port}", f"http://127.0.0.1:{hml_port}",
+            max_pages=len(FIXTURE_PAGES) + 1, workers=workers,
+            diff_workers=diff_workers, save_screenshots=False, cache_dir=None, use_baselines=False,
+        )
+        comparator.run_comparison()
+        results_dir = os.path.join(run_dir, comparator.results_dir)
+        with open(os.path.join(results_dir, 'results.json'), encoding='utf-8') as f:
+            results = json.load(f)['results']
+        with open(os.path.join(results_dir, 'timings.json'), encoding='utf-8') as f:
+            stages = json.load(f)['stages']
+    finally:
+        os.chdir(previous_dir)
+
+    peaks = [r['diff_peak_rss'] for r in results if r.get('diff_peak_rss')]
+    return {
+        'pages': len(results),
+        'elapsed_seconds': comparator.run_stats.get('elapsed_seconds'),
+        'pages_per_minute': comparator.run_stats.get('pages_per_minute'),
+        'diff_peak_rss_mb': max(peaks) / 1024 ** 2 if peaks else None,
+        'stages': stages,
+        'accuracy': check_accuracy(results),
+    }
+
+
+def aggregate(runs):
+    """Mediana das métricas entre execuções; a precisão precisa passar em todas"""
+    median = lambda values: statistics.median(values) if values else None
+    stages = {}
+    for stage in sorted({stage for run in runs for stage in run['stages']}):
+        per_run = [run['stages'][stage] for run in runs if stage in run['stages']]
+        stages[stage] = {key: median([stats[key] for stats in per_run]) for key in ('p50', 'p95', 'max')}
+    return {
+        'pages_per_minute': median([run['pages_per_minute'] for run in runs if run['pages_per_minute']]),
+        'diff_peak_rss_mb': median([run['diff_peak_rss_mb'] for run in runs if run['diff_peak_rss_mb']]),
+        'stages': stages,
+        'accuracy_ok': all(check['ok'] for run in runs for check in run['accuracy']),
+    }
+
+
+def compare_with_baseline(summary, baseline, tolerance=REGRESSION_TOLERANCE):
+    """Lista as métricas que pioraram mais que a tolerância em relação ao baseline"""
+    # (nome, atual, anterior, maior_é_melhor)
+    metrics = [('pages_per_minute', summary['pages_per_minute'], baseline.get('pages_per_minute'), True),
+               ('diff_peak_rss_mb', summary['diff_peak_rss_mb'], baseline.get('diff_peak_rss_mb'), False)]
+    for stage, stats in summary['stages'].items():
+        previous = baseline.get('stages', {}).get(stage)
+        if previous:
+            metrics.append((f"{stage} p95", stats['p95'], previous['p95'], False))
+
+    changes = []
+    for name, current, previous, higher_is_better in metrics:
+        if not current or not previous:
+            continue
+        change = (current - previous) / previous
+        worse = -change if higher_is_better else change
+        changes.append({'metric': name, 'current': current, 'baseline': previous,
+                        'change': change, 'regression': worse > tolerance})
+    return changes
+
+
+def latest_result(output_dir):
+    paths = sorted(glob.glob(os.path.join(output_dir, 'benchmark_*.json')))
+    return paths[-1] if paths else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline do comparador visual")
+    parser.add_argument('--runs', type=int, default=1, help="número de execuções (usa a mediana)")
+    parser.add_argument('--workers', type=int, default=4, help="workers de captura")
+    parser.add_argument('--diff-workers', type=int, default=None, help="processos de diff")
+    parser.add_argument('--output-dir', default=DEFAULT_OUTPUT_DIR, help="onde salvar os resultados")
+    parser.add_argument('--baseline', help="resultado anterior para comparar (padrão: o mais recente)")
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE,
+                        help="piora relativa tolerada antes de acusar regressão")
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help="sai com código 2 se alguma métrica regredir")
+    parser.add_argument('--font', help="fonte .ttf usada na página de fontes atrasadas")
+    parser.add_argument('--keep-fixture', action='store_true', help="não apaga o diretório do fixture")
+    args = parser.parse_args()
+
+    output_dir = os.path.abspath(args.output_dir)
+    baseline_path = args.baseline or latest_result(output_dir)
+    fixture_root = tempfile.mkdtemp(prefix='visual_diff_bench_')
+    font_path = build_fixture(fixture_root, args.font)
+    prod_server, prod_port = serve(os.path.join(fixture_root, 'prod'))
+    hml_server, hml_port = serve(os.path.join(fixture_root, 'hml'))
+    print(f"🧪 Fixture em {fixture_root} (prod :{prod_port}, hml :{hml_port})")
+
+    try:
+        runs = []
+        for run in range(1, args.runs + 1):
+            print(f"\n🏁 Execução {run}/{args.runs}")
+            runs.append(run_once(fixture_root, prod_port, hml_port, args.workers, args.diff_workers))
+    finally:
+        prod_server.shutdown()
+        hml_server.shutdown()
+        if not args.keep_fixture:
+            shutil.rmtree(fixture_root, ignore_errors=True)
+
+    summary = aggregate(runs)
+    record = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'config': {'runs': args.runs, 'workers': args.workers, 'diff_workers': args.diff_workers,
+                   'font': bool(font_path), 'pages': len(FIXTURE_PAGES) + 1},
+        **summary,
+        'runs': runs,
+    }
+
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, f"benchmark_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(record, f, ensure_ascii=False, indent=2)
+
+    print("\n" + "=" * 60)
+    print(f"📊 {summary['pages_per_minute'] or 0:.1f} páginas/minuto")
+    if summary['diff_peak_rss_mb']:
+        print(f"🧠 Pico de memória do diff: {summary['diff_peak_rss_mb']:.0f} MB")
+    for stage, stats in summary['stages'].items():
+        print(f"   ⏱️  {stage}: p50 {stats['p50']:.0f} ms, p95 {stats['p95']:.0f} ms, máx {stats['max']:.0f} ms")
+
+    print("\n🎯 Precisão do diff:")
+    for check in runs[-1]['accuracy']:
+        actual = f"{check['actual']:.2f}%" if check['actual'] is not None else 'falhou'
+        print(f"   {'✅' if check['ok'] else '❌'} {check['page']} ({check['kind']}): "
+              f"esperado {check['expected']:.2f}%, medido {actual}")
+
+    regressions = []
+    if baseline_path and os.path.exists(baseline_path):
+        with open(baseline_path, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"\n📈 Comparação com {os.path.basename(baseline_path)}:")
+        for change in compare_with_baseline(summary, baseline, args.tolerance):
+            marker = '⚠️ ' if change['regression'] else '  '
+            print(f"   {marker}{change['metric']}: {change['baseline']:.1f} → {change['current']:.1f} "
+                  f"({change['change'] * 100:+.0f}%)")
+            if change['regression']:
+                regressions.append(change['metric'])
+    print(f"\n💾 Resultado salvo em {output_path}")
+
+    if not summary['accuracy_ok']:
+        print("❌ A precisão do diff não bate com as diferenças conhecidas do fixture")
+        return 1
+    if regressions and args.fail_on_regression:
+        print(f"❌ Regressões: {', '.join(regressions)}")
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,29 +1,2483 @@
-import requests
-from bs4 import BeautifulSoup
-from playwright.sync_api import sync_playwright
-from urllib.parse import urljoin, urlparse
-import cv2
-import numpy as np
+from urllib.parse import urljoin, urlparse, urlunparse, parse_qsl, urlencode
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, contextmanager
+from collections import deque
+import xml.etree.ElementTree as ET
+import argparse
+import asyncio
+import difflib
+import gzip
+import hashlib
+import importlib
+import json
+import math
+import multiprocessing
+import shutil
+import sqlite3
+import sys
+import threading
 import os
 from datetime import datetime
+from html import escape
+from email.utils import parsedate_to_datetime
 import time
 import re
-from prompt_toolkit import prompt
+
+
+class _LazyModule:
+    """Adia o import de uma dependência pesada até o primeiro uso de um atributo
+    
+    OpenCV, NumPy e requests só são carregados quando alguma etapa precisa deles,
+    então --help, a leitura da configuração e a retomada começam na hora.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+cv2 = _LazyModule('cv2')
+np = _LazyModule('numpy')
+requests = _LazyModule('requests')
+
+
+# Extensões que não são páginas HTML e não devem entrar na comparação
+SKIPPED_EXTENSIONS = ('.pdf', '.jpg', '.jpeg', '.png', '.gif', '.svg', '.webp', '.css', '.js',
+                      '.zip', '.xml', '.json', '.ico', '.mp4', '.mp3')
+
+# Parâmetros de rastreamento removidos da query na normalização
+TRACKING_PARAMS = ('utm_', 'gclid', 'fbclid', 'mc_cid', 'mc_eid')
+
+
+def canonicalize_url(url, scheme=None):
+    """Normaliza uma URL para deduplicação (esquema, host, barra final e query)"""
+    parsed = urlparse(url.strip())
+    scheme = (scheme or parsed.scheme or 'https').lower()
+    netloc = parsed.netloc.lower()
+    
+    # Remove portas padrão (http://site:80 == http://site)
+    for default_scheme, default_port in (('http', ':80'), ('https', ':443')):
+        if netloc.endswith(default_port) and parsed.scheme.lower() == default_scheme:
+            netloc = netloc[:-len(default_port)]
+    
+    # Colapsa barras repetidas e remove a barra final (a raiz vira string vazia)
+    path = re.sub(r'/{2,}', '/', parsed.path).rstrip('/')
+    
+    # Ordena a query e descarta parâmetros de rastreamento
+    params = [(k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+              if not k.lower().startswith(TRACKING_PARAMS)]
+    query = urlencode(sorted(params))
+    
+    # O fragmento (#secao) nunca identifica uma página diferente
+    return urlunparse((scheme, netloc, path, '', query, ''))
+
+
+# Diretório padrão dos caches persistentes (diffs, etc.), compartilhado entre execuções
+DEFAULT_CACHE_DIR = '.visual_diff_cache'
+
+# Domínios de terceiros bloqueados por padrão (analytics, chat, anúncios): não mudam o layout
+# testado e impedem a rede de ficar ociosa. Subdomínios também são bloqueados.
+DEFAULT_BLOCKED_DOMAINS = (
+    'google-analytics.com', 'googletagmanager.com', 'doubleclick.net', 'googlesyndication.com',
+    'googleadservices.com', 'adservice.google.com', 'connect.facebook.net', 'hotjar.com',
+    'clarity.ms', 'segment.io', 'segment.com', 'mixpanel.com', 'intercom.io', 'intercomcdn.com',
+    'zdassets.com', 'tawk.to', 'crisp.chat', 'hs-analytics.net', 'hs-scripts.com', 'newrelic.com',
+    'nr-data.net', 'taboola.com', 'outbrain.com', 'criteo.com', 'criteo.net',
+)
+
+# Impressão digital do DOM: nós cujo conteúdo muda a cada requisição sem mudar o layout
+# (seletores CSS) e trechos de texto mascarados no HTML serializado (regex)
+DEFAULT_FINGERPRINT_MASK_SELECTORS = (
+    'script', 'noscript', 'time', 'input[type="hidden"]', 'meta[name="csrf-token"]',
+    'meta[name="csrf-param"]', '[data-timestamp]',
+)
+DEFAULT_FINGERPRINT_MASK_PATTERNS = (
+    r'\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?',
+    r'\b[0-9a-fA-F]{32,}\b',
+)
+
+# Diferença (%) a partir da qual uma página conta como grande diferença (e o modo batch falha)
+HIGH_DIFF_THRESHOLD = 10.0
+
+# Altura (px) das faixas do diff em modo tile e a partir de quando ele é usado automaticamente
+TILE_HEIGHT = 2000
+TILED_DIFF_MIN_HEIGHT = 8000
+
+# Perfis de captura: viewports prontos (nome -> opções do contexto do Playwright) e navegadores
+VIEWPORT_PRESETS = {
+    'desktop': {'viewport': {'width': 1200, 'height': 800}},
+    'tablet': {'viewport': {'width': 768, 'height': 1024}, 'is_mobile': True, 'has_touch': True},
+    'mobile': {'viewport': {'width': 390, 'height': 844}, 'is_mobile': True, 'has_touch': True},
+}
+SUPPORTED_BROWSERS = ('chromium', 'firefox', 'webkit')
+
+# Miniatura da comparação usada no relatório (WebP tem limite de 16383 px por dimensão)
+THUMBNAIL_WIDTH = 480
+THUMBNAIL_QUALITY = 80
+THUMBNAIL_MAX_HEIGHT = 16383
+
+
+def build_profiles(viewports=('desktop',), browsers=('chromium',)):
+    """Matriz de perfis de captura (navegador x viewport)
+    
+    Viewports podem ser nomes de VIEWPORT_PRESETS, 'LARGURAxALTURA' ou dicts com 'name' e
+    as opções de contexto do Playwright. Cada perfil tem uma chave ('chromium-mobile') que
+    identifica as saídas, os baselines e as entradas do relatório.
+    """
+    profiles = []
+    for browser in browsers:
+        if browser not in SUPPORTED_BROWSERS:
+            raise ValueError(f"Navegador não suportado: {browser}")
+        for viewport in viewports:
+            if isinstance(viewport, dict):
+                options = dict(viewport)
+                name = options.pop('name')
+            elif viewport in VIEWPORT_PRESETS:
+                name, options = viewport, dict(VIEWPORT_PRESETS[viewport])
+            elif re.fullmatch(r'\d+x\d+', viewport):
+                width, height = (int(v) for v in viewport.split('x'))
+                name, options = viewport, {'viewport': {'width': width, 'height': height}}
+            else:
+                raise ValueError(f"Viewport desconhecida: {viewport}")
+            if browser == 'firefox':
+                # O Firefox do Playwright não emula dispositivos móveis
+                options.pop('is_mobile', None)
+            size = options['viewport']
+            # A chave do baseline cobre toda a emulação (is_mobile, has_touch, DPR...), não só o
+            # tamanho; perfis só com a viewport mantêm a chave 'LARGURAxALTURA'
+            viewport_key = f"{size['width']}x{size['height']}"
+            emulation = {key: value for key, value in options.items() if key != 'viewport'}
+            if emulation:
+                digest = hashlib.blake2b(json.dumps(emulation, sort_keys=True).encode(), digest_size=4).hexdigest()
+                viewport_key += f"-{digest}"
+            profiles.append({
+                'key': f"{browser}-{name}",
+                'browser': browser,
+                'name': name,
+                'viewport_key': viewport_key,
+                'context_options': options,
+            })
+    return profiles
+
+
+def shard_of(url, shard_count):
+    """Shard (0-based) de uma página pelo hash da URL canônica
+    
+    Depende só da URL, não da posição na lista: páginas novas não mudam o shard das existentes.
+    """
+    digest = hashlib.blake2b(canonicalize_url(url).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shard_count
+
+
+def parse_shard(value):
+    """Converte 'i/N' (1-based) em (i, N)"""
+    match = re.fullmatch(r'(\d+)/(\d+)', value.strip())
+    if not match:
+        raise ValueError(f"Shard inválido: {value} (use i/N, ex.: 1/4)")
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= count:
+        raise ValueError(f"Shard inválido: {value} (i deve estar entre 1 e N)")
+    return index, count
+
+
+def load_image(source):
+    """Decodifica uma imagem a partir de caminho, bytes codificados ou array (sem cópia)"""
+    if isinstance(source, np.ndarray):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_COLOR)
+    return cv2.imread(source)
+
+
+def pixel_hash(img):
+    """Hash de conteúdo dos pixels decodificados (inclui as dimensões)"""
+    digest = hashlib.blake2b(repr(img.shape).encode(), digest_size=20)
+    digest.update(np.ascontiguousarray(img).data)
+    return digest.hexdigest()
+
+
+def dhash(img, hash_size=16):
+    """Hash perceptual por gradiente (dHash) com hash_size² bits"""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return np.packbits(small[:, 1:] > small[:, :-1])
+
+
+def hamming_distance(hash_a, hash_b):
+    return int(np.unpackbits(np.bitwise_xor(hash_a, hash_b)).sum())
+
+
+def content_hash(data):
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+async def document_validators(response):
+    """Extrai ETag, Last-Modified e o hash do HTML servido a partir da resposta da navegação"""
+    validators = {'etag': None, 'last_modified': None, 'dom_hash': None}
+    if response is None:
+        return validators
+    headers = response.headers
+    validators['etag'] = headers.get('etag')
+    validators['last_modified'] = headers.get('last-modified')
+    try:
+        validators['dom_hash'] = content_hash(await response.body())
+    except Exception:
+        # Redirecionamentos e respostas descartadas não têm corpo disponível
+        pass
+    return validators
+
+
+class BaselineStore:
+    """Baselines persistentes da produção: screenshots em disco e índice SQLite
+    
+    Cada entrada é identificada por (URL canônica, viewport, navegador) e guarda os validadores
+    HTTP do documento para decidir se a produção precisa ser recapturada.
+    """
+
+    def __init__(self, store_dir, max_age_days=7, max_bytes=2 * 1024 ** 3):
+        self.store_dir = store_dir
+        self.images_dir = os.path.join(store_dir, 'images')
+        self.max_age_days = max_age_days
+        self.max_bytes = max_bytes
+        os.makedirs(self.images_dir, exist_ok=True)
+        
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(store_dir, 'index.sqlite'), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS baselines (
+                    url TEXT NOT NULL,
+                    viewport TEXT NOT NULL,
+                    browser TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    dom_hash TEXT,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL,
+                    PRIMARY KEY (url, viewport, browser)
+                )
+            """)
+
+    def get(self, url, viewport, browser):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM baselines WHERE url = ? AND viewport = ? AND browser = ?",
+                (canonicalize_url(url), viewport, browser)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def load(self, entry):
+        """Lê o screenshot do baseline e marca o uso (para a política LRU)"""
+        try:
+            with open(os.path.join(self.images_dir, entry['path']), 'rb') as f:
+                image = f.read()
+        except OSError:
+            return None
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE baselines SET last_used_at = ? WHERE url = ? AND viewport = ? AND browser = ?",
+                (time.time(), entry['url'], entry['viewport'], entry['browser'])
+            )
+        return image
+
+    def put(self, url, viewport, browser, capture):
+        url = canonicalize_url(url)
+        name = f"{content_hash(f'{url}|{viewport}|{browser}'.encode())}.png"
+        tmp_path = os.path.join(self.images_dir, f"{name}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(capture['image'])
+        os.replace(tmp_path, os.path.join(self.images_dir, name))
+        
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO baselines VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, viewport, browser, name, capture.get('etag'), capture.get('last_modified'),
+                 capture.get('dom_hash'), len(capture['image']), now, now)
+            )
+
+    def _delete(self, rows):
+        for row in rows:
+            try:
+                os.remove(os.path.join(self.images_dir, row['path']))
+            except OSError:
+                pass
+        self._conn.executemany(
+            "DELETE FROM baselines WHERE url = ? AND viewport = ? AND browser = ?",
+            [(row['url'], row['viewport'], row['browser']) for row in rows]
+        )
+
+    def evict(self):
+        """Remove baselines mais velhos que max_age_days e, se preciso, os menos usados até caber em max_bytes"""
+        with self._lock, self._conn:
+            cutoff = time.time() - self.max_age_days * 86400
+            expired = self._conn.execute("SELECT * FROM baselines WHERE created_at < ?", (cutoff,)).fetchall()
+            self._delete(expired)
+            
+            rows = self._conn.execute("SELECT * FROM baselines ORDER BY last_used_at DESC").fetchall()
+            total = 0
+            over_budget = []
+            for row in rows:
+                total += row['size']
+                if total > self.max_bytes:
+                    over_budget.append(row)
+            self._delete(over_budget)
+        return len(expired) + len(over_budget)
+
+
+class StageTimer:
+    """Spans de tempo por etapa (descoberta, captura, diff, relatório), marcados com página e ambiente
+    
+    Cada span é só um dict numa lista, então a instrumentação fica sempre ligada. Os processos
+    de diff usam um StageTimer próprio e devolvem os spans junto com o resultado da página.
+    """
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage, page=None, env=None):
+        start = time.time()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, (time.perf_counter() - started) * 1000, page=page, env=env, start=start)
+
+    def record(self, stage, duration_ms, page=None, env=None, start=None):
+        # time.time() no início permite alinhar spans de processos diferentes na cascata
+        if start is None:
+            start = time.time() - duration_ms / 1000
+        span = {'stage': stage, 'page': page, 'env': env, 'start': start, 'duration_ms': round(duration_ms, 2)}
+        with self._lock:
+            self.spans.append(span)
+
+    def extend(self, spans):
+        with self._lock:
+            self.spans.extend(spans)
+
+    def page_spans(self, page):
+        with self._lock:
+            return sorted((span for span in self.spans if span['page'] == page), key=lambda span: span['start'])
+
+    def summary(self):
+        """p50/p95/máximo (ms) de cada etapa"""
+        durations = {}
+        with self._lock:
+            for span in self.spans:
+                durations.setdefault(span['stage'], []).append(span['duration_ms'])
+        summary = {}
+        for stage, values in sorted(durations.items()):
+            values.sort()
+            # Percentil pelo método nearest-rank
+            rank = lambda q: values[max(0, math.ceil(q * len(values)) - 1)]
+            summary[stage] = {'count': len(values), 'p50': rank(0.5), 'p95': rank(0.95),
+                              'max': values[-1], 'total': round(sum(values), 2)}
+        return summary
+
+    def export(self, results_dir, prefix='visual_diff'):
+        """Grava timings.json (resumo + spans) e timings.prom (formato textfile do Prometheus)"""
+        summary = self.summary()
+        with self._lock:
+            spans = list(self.spans)
+        
+        lines = [
+            f"# HELP {prefix}_stage_duration_seconds Duração das etapas por span",
+            f"# TYPE {prefix}_stage_duration_seconds summary",
+        ]
+        for stage, stats in summary.items():
+            labels = f'stage="{stage}"'
+            lines.append(f'{prefix}_stage_duration_seconds{{{labels},quantile="0.5"}} {stats["p50"] / 1000:.6f}')
+            lines.append(f'{prefix}_stage_duration_seconds{{{labels},quantile="0.95"}} {stats["p95"] / 1000:.6f}')
+            lines.append(f'{prefix}_stage_duration_seconds_sum{{{labels}}} {stats["total"] / 1000:.6f}')
+            lines.append(f'{prefix}_stage_duration_seconds_count{{{labels}}} {stats["count"]}')
+        lines.append(f"# HELP {prefix}_stage_duration_max_seconds Maior duração observada por etapa")
+        lines.append(f"# TYPE {prefix}_stage_duration_max_seconds gauge")
+        for stage, stats in summary.items():
+            lines.append(f'{prefix}_stage_duration_max_seconds{{stage="{stage}"}} {stats["max"] / 1000:.6f}')
+        
+        # Gravação atômica: o coletor textfile pode ler o arquivo a qualquer momento
+        outputs = {
+            'timings.json': json.dumps({'stages': summary, 'spans': spans}, ensure_ascii=False, indent=2),
+            'timings.prom': '\n'.join(lines) + '\n',
+        }
+        for name, content in outputs.items():
+            path = os.path.join(results_dir, name)
+            with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+                f.write(content)
+            os.replace(f"{path}.tmp", path)
+        return summary
+
+
+class DiffCache:
+    """Cache em disco de resultados de diff, endereçado pelo hash dos pixels das duas imagens
+    
+    Cada entrada guarda o resultado em JSON e as imagens de comparação já geradas.
+    É seguro entre processos: entradas são montadas em diretório temporário e renomeadas.
+    O último uso de uma entrada é o mtime do result.json; evict() remove as não usadas há mais
+    de max_age_days e, acima de max_bytes, as usadas há mais tempo.
+    """
+
+    KINDS = ('images', 'region_images', 'thumbnails')
+    HEADER_HEIGHT = 80
+
+    def __init__(self, cache_dir, max_age_days=7, max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_age_days = max_age_days
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(prod_hash, hml_hash, diff_mode, strip_height):
+        # O prefixo de versão invalida entradas gravadas num formato anterior
+        raw = f"v3:{prod_hash}:{hml_hash}:{diff_mode}:{strip_height}"
+        return hashlib.blake2b(raw.encode(), digest_size=20).hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key, output_path, page_name=None, hml_offset=None):
+        """Copia as imagens em cache para o destino e devolve o resultado (ou None)
+        
+        Se a entrada foi gerada para outra página, o cabeçalho (que traz o nome da página)
+        é redesenhado na composição e na miniatura copiadas.
+        """
+        entry_dir = self._entry_dir(key)
+        result_path = os.path.join(entry_dir, 'result.json')
+        try:
+            with open(result_path, encoding='utf-8') as f:
+                entry = json.load(f)
+            base, ext = os.path.splitext(output_path)
+            outcome = {'diff_percentage': entry['diff_percentage'], 'regions': entry.get('regions', [])}
+            for kind in self.KINDS:
+                outcome[kind] = []
+                for suffix in entry['suffixes'].get(kind, []):
+                    target = f"{base}{suffix}"
+                    shutil.copyfile(os.path.join(entry_dir, f"image{suffix}"), target)
+                    outcome[kind].append(os.path.basename(target))
+            thumbnails = outcome.pop('thumbnails')
+            outcome['thumbnail'] = thumbnails[0] if thumbnails else None
+            # Os recortes são renomeados com o nome da página atual
+            for region in outcome['regions']:
+                region['image'] = f"{os.path.basename(base)}_region_{region['index']:02d}{ext}"
+            if page_name and hml_offset and entry.get('page_name') != page_name:
+                self.relabel(outcome, os.path.dirname(output_path), page_name, hml_offset)
+            # Marca o uso para a evicção LRU
+            os.utime(result_path)
+        except (OSError, ValueError, KeyError, AttributeError):
+            return None
+        return outcome
+
+    def relabel(self, outcome, directory, page_name, hml_offset):
+        """Redesenha o cabeçalho no topo da primeira imagem (composição ou tile 000) e da miniatura"""
+        if not outcome['images']:
+            return
+        path = os.path.join(directory, outcome['images'][0])
+        image = cv2.imread(path, cv2.IMREAD_COLOR)
+        if image is None:
+            return
+        header = comparison_header(image.shape[1], hml_offset, page_name, outcome['diff_percentage'])
+        image[:self.HEADER_HEIGHT] = header
+        cv2.imwrite(path, image)
+        
+        if outcome.get('thumbnail'):
+            thumb_path = os.path.join(directory, outcome['thumbnail'])
+            thumbnail = cv2.imread(thumb_path, cv2.IMREAD_COLOR)
+            if thumbnail is None:
+                return
+            height = min(thumbnail.shape[0], max(1, round(self.HEADER_HEIGHT * thumbnail.shape[1] / image.shape[1])))
+            thumbnail[:height] = cv2.resize(header, (thumbnail.shape[1], height), interpolation=cv2.INTER_AREA)
+            cv2.imwrite(thumb_path, thumbnail, [cv2.IMWRITE_WEBP_QUALITY, THUMBNAIL_QUALITY])
+
+    def evict(self):
+        """Remove entradas sem uso há mais de max_age_days e, acima de max_bytes, as menos usadas"""
+        cutoff = time.time() - self.max_age_days * 86400
+        entries = []
+        for prefix in os.listdir(self.cache_dir):
+            prefix_dir = os.path.join(self.cache_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                entry_dir = os.path.join(prefix_dir, name)
+                try:
+                    if name.endswith('.tmp'):
+                        # Sobra de um processo interrompido (as em andamento são recentes)
+                        if os.path.getmtime(entry_dir) < time.time() - 3600:
+                            shutil.rmtree(entry_dir, ignore_errors=True)
+                        continue
+                    last_used = os.path.getmtime(os.path.join(entry_dir, 'result.json'))
+                    size = sum(entry.stat().st_size for entry in os.scandir(entry_dir))
+                except OSError:
+                    continue
+                entries.append((last_used, size, entry_dir))
+        
+        removed = 0
+        total = 0
+        for last_used, size, entry_dir in sorted(entries, reverse=True):
+            total += size
+            if last_used < cutoff or total > self.max_bytes:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                removed += 1
+                try:
+                    # Remove o diretório de prefixo se ficou vazio
+                    os.rmdir(os.path.dirname(entry_dir))
+                except OSError:
+                    pass
+        return removed
+
+    def put(self, key, output_path, outcome, page_name=None):
+        entry_dir = self._entry_dir(key)
+        if os.path.isdir(entry_dir):
+            return
+        base = os.path.splitext(output_path)[0]
+        base_name = os.path.basename(base)
+        tmp_dir = f"{entry_dir}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(tmp_dir, exist_ok=True)
+            suffixes = {}
+            files = dict(outcome, thumbnails=[outcome['thumbnail']] if outcome.get('thumbnail') else [])
+            for kind in self.KINDS:
+                suffixes[kind] = []
+                for image in files.get(kind, []):
+                    # Guarda só o sufixo ('.png', '_001.png', '_thumb.webp'); o nome da página muda entre execuções
+                    suffix = image[len(base_name):]
+                    shutil.copyfile(os.path.join(os.path.dirname(output_path), image),
+                                    os.path.join(tmp_dir, f"image{suffix}"))
+                    suffixes[kind].append(suffix)
+            with open(os.path.join(tmp_dir, 'result.json'), 'w', encoding='utf-8') as f:
+                json.dump({'diff_percentage': outcome['diff_percentage'], 'suffixes': suffixes,
+                           'regions': outcome.get('regions', []), 'page_name': page_name}, f)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Outro processo gravou a mesma entrada primeiro (ou falta espaço): o cache é opcional
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def downscale(img, width=THUMBNAIL_WIDTH):
+    """Reduz a imagem para a largura dada mantendo a proporção (nunca amplia)"""
+    if img.shape[1] <= width:
+        return img
+    height = max(1, round(img.shape[0] * width / img.shape[1]))
+    return cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def save_thumbnail(parts, path, quality=THUMBNAIL_QUALITY):
+    """Empilha as partes já reduzidas e grava a miniatura em WebP; devolve o nome do arquivo"""
+    thumbnail = np.vstack(parts) if len(parts) > 1 else parts[0]
+    if thumbnail.shape[0] > THUMBNAIL_MAX_HEIGHT:
+        scale = THUMBNAIL_MAX_HEIGHT / thumbnail.shape[0]
+        thumbnail = cv2.resize(thumbnail, (max(1, int(thumbnail.shape[1] * scale)), THUMBNAIL_MAX_HEIGHT),
+                               interpolation=cv2.INTER_AREA)
+    cv2.imwrite(path, thumbnail, [cv2.IMWRITE_WEBP_QUALITY, quality])
+    return os.path.basename(path)
+
+
+def comparison_header(width, hml_offset, page_name, diff_percentage):
+    """Desenha o cabeçalho da imagem de comparação (página, colunas e percentual)"""
+    header_height = 80
+    header = np.ones((header_height, width, 3), dtype=np.uint8) * 50
+    
+    # Adiciona texto no cabeçalho
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    font_scale = 0.7
+    thickness = 2
+    
+    # Título da página
+    cv2.putText(header, f"PAGINA: {page_name}", (10, 25), font, font_scale, (255, 255, 255), thickness)
+    
+    # Labels das colunas
+    cv2.putText(header, "PRODUCAO", (10, 55), font, font_scale, (0, 255, 0), thickness)
+    hml_x = hml_offset + 30
+    cv2.putText(header, "HOMOLOGACAO", (hml_x, 55), font, font_scale, (0, 100, 255), thickness)
+    
+    # Porcentagem de diferença
+    diff_color = (0, 0, 255) if diff_percentage > 5 else (0, 255, 0)
+    diff_x = width - 300
+    cv2.putText(header, f"DIFF: {diff_percentage:.1f}%", (diff_x, 40), font, font_scale, diff_color, thickness)
+    return header
+
+
+# Regiões alteradas: tamanho do agrupamento morfológico (px), menor região considerada,
+# quantas regiões guardar por página e largura máxima dos recortes no relatório
+REGION_KERNEL_SIZE = 25
+REGION_MIN_PIXELS = 16
+MAX_REGIONS = 20
+REGION_THUMBNAIL_WIDTH = 600
+
+# Estado de cada linha do alinhamento vertical
+ROW_EQUAL, ROW_CHANGED, ROW_GAP = 0, 1, 2
+
+# Cor das linhas que só existem em um dos lados (faixa inserida/removida)
+GAP_COLOR = (200, 200, 255)
+
+_ROW_HASH_SEED = 0x5EED
+
+
+def row_hashes(img, chunk_rows=2048):
+    """Hash de 64 bits de cada linha de pixels, calculado em blocos com NumPy"""
+    height = img.shape[0]
+    flat = img.reshape(height, -1)
+    row_bytes = flat.shape[1]
+    words = -(-row_bytes // 8)
+    # Pesos ímpares aleatórios (fixos): soma ponderada módulo 2^64 das palavras da linha
+    weights = np.random.default_rng(_ROW_HASH_SEED).integers(1, 2 ** 63, size=words, dtype=np.uint64) | np.uint64(1)
+    
+    hashes = np.empty(height, dtype=np.uint64)
+    for y0 in range(0, height, chunk_rows):
+        chunk = flat[y0:y0 + chunk_rows]
+        if row_bytes % 8:
+            chunk = np.pad(chunk, ((0, 0), (0, words * 8 - row_bytes)))
+        chunk = np.ascontiguousarray(chunk).view(np.uint64)
+        hashes[y0:y0 + len(chunk)] = (chunk * weights).sum(axis=1, dtype=np.uint64)
+    return hashes
+
+
+def align_rows(prod_hashes, hml_hashes):
+    """Alinha as sequências de linhas das duas imagens (LCS via difflib)
+    
+    Devolve três arrays do tamanho do alinhamento: o índice da linha em cada imagem (-1 onde
+    a linha não existe daquele lado) e o estado da linha (ROW_EQUAL, ROW_CHANGED ou ROW_GAP).
+    """
+    n, m = len(prod_hashes), len(hml_hashes)
+    
+    # Prefixo e sufixo comuns saem direto do NumPy; só o miolo passa pelo difflib
+    common = min(n, m)
+    mismatch = np.flatnonzero(prod_hashes[:common] != hml_hashes[:common])
+    prefix = int(mismatch[0]) if len(mismatch) else common
+    tail = min(n, m) - prefix
+    mismatch = np.flatnonzero(prod_hashes[n - tail:][::-1] != hml_hashes[m - tail:][::-1]) if tail else []
+    suffix = int(mismatch[0]) if len(mismatch) else tail
+    
+    prod_parts, hml_parts, state_parts = [], [], []
+    
+    def add(prod_rows, hml_rows, state):
+        prod_parts.append(prod_rows)
+        hml_parts.append(hml_rows)
+        state_parts.append(np.full(len(prod_rows), state, dtype=np.uint8))
+    
+    def gap(length):
+        return np.full(length, -1, dtype=np.int64)
+    
+    if prefix:
+        add(np.arange(prefix), np.arange(prefix), ROW_EQUAL)
+    
+    prod_mid = prod_hashes[prefix:n - suffix].tolist()
+    hml_mid = hml_hashes[prefix:m - suffix].tolist()
+    matcher = difflib.SequenceMatcher(None, prod_mid, hml_mid, autojunk=True)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        i1, i2, j1, j2 = i1 + prefix, i2 + prefix, j1 + prefix, j2 + prefix
+        if tag == 'equal':
+            add(np.arange(i1, i2), np.arange(j1, j2), ROW_EQUAL)
+        elif tag == 'delete':
+            add(np.arange(i1, i2), gap(i2 - i1), ROW_GAP)
+        elif tag == 'insert':
+            add(gap(j2 - j1), np.arange(j1, j2), ROW_GAP)
+        else:
+            # Troca: as linhas em correspondência são comparadas pixel a pixel; o excesso é faixa inserida
+            paired = min(i2 - i1, j2 - j1)
+            add(np.arange(i1, i1 + paired), np.arange(j1, j1 + paired), ROW_CHANGED)
+            if i2 - i1 > paired:
+                add(np.arange(i1 + paired, i2), gap(i2 - i1 - paired), ROW_GAP)
+            if j2 - j1 > paired:
+                add(gap(j2 - j1 - paired), np.arange(j1 + paired, j2), ROW_GAP)
+    
+    if suffix:
+        add(np.arange(n - suffix, n), np.arange(m - suffix, m), ROW_EQUAL)
+    
+    if not state_parts:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0, dtype=np.uint8)
+    return np.concatenate(prod_parts), np.concatenate(hml_parts), np.concatenate(state_parts)
+
+
+def aligned_strip(img, index):
+    """Monta as linhas alinhadas de uma imagem; linhas ausentes recebem GAP_COLOR"""
+    strip = np.empty((len(index), img.shape[1], 3), dtype=np.uint8)
+    strip[:] = GAP_COLOR
+    present = index >= 0
+    strip[present] = img[index[present]]
+    return strip
+
+
+def diff_mask(prod_strip, hml_strip, states):
+    """Máscara (uint8) dos pixels alterados de uma faixa alinhada
+    
+    Linhas iguais não são comparadas; linhas trocadas passam pelo limiar de 30 níveis de
+    cinza; faixas inseridas ou removidas contam inteiras.
+    """
+    mask = np.zeros(prod_strip.shape[:2], dtype=np.uint8)
+    mask[states == ROW_GAP] = 255
+    rows = states == ROW_CHANGED
+    if rows.any():
+        diff = cv2.absdiff(prod_strip[rows], hml_strip[rows])
+        gray_diff = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY)
+        _, mask[rows] = cv2.threshold(gray_diff, 30, 255, cv2.THRESH_BINARY)
+    return mask
+
+
+def find_regions(mask, y_offset=0, kernel_size=REGION_KERNEL_SIZE, min_pixels=REGION_MIN_PIXELS):
+    """Agrupa os pixels alterados em regiões (fechamento morfológico + componentes conexos)"""
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (kernel_size, kernel_size))
+    grouped = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+    count, _, stats, _ = cv2.connectedComponentsWithStats(grouped, connectivity=8)
+    
+    regions = []
+    for label in range(1, count):
+        x, y, w, h, _ = (int(v) for v in stats[label])
+        changed = int(np.count_nonzero(mask[y:y + h, x:x + w]))
+        if changed < min_pixels:
+            continue
+        regions.append({'x': x, 'y': y + y_offset, 'width': w, 'height': h, 'changed_pixels': changed})
+    return regions
+
+
+def merge_regions(regions, gap=REGION_KERNEL_SIZE):
+    """Une regiões que se tocam (ex.: a mesma mudança cortada na divisa entre duas faixas)
+    
+    Varredura por y: cada região só é comparada com as que ainda alcançam a sua linha, então
+    milhares de regiões espalhadas não viram um custo cúbico. Uma união pode fazer a caixa tocar
+    uma região já passada, por isso a varredura se repete até nenhuma união acontecer.
+    """
+    merged = [dict(r) for r in regions]
+    changed = True
+    while changed:
+        changed = False
+        merged.sort(key=lambda r: r['y'])
+        result = []
+        active = []
+        for region in merged:
+            # Caixas que terminam antes desta linha (mais a folga) não tocam mais nenhuma
+            active = [a for a in active if a['y'] + a['height'] + gap >= region['y']]
+            for a in active:
+                if a['x'] <= region['x'] + region['width'] + gap and region['x'] <= a['x'] + a['width'] + gap:
+                    x0, y0 = min(a['x'], region['x']), min(a['y'], region['y'])
+                    x1 = max(a['x'] + a['width'], region['x'] + region['width'])
+                    y1 = max(a['y'] + a['height'], region['y'] + region['height'])
+                    a.update({'x': x0, 'y': y0, 'width': x1 - x0, 'height': y1 - y0,
+                              'changed_pixels': a['changed_pixels'] + region['changed_pixels']})
+                    changed = True
+                    break
+            else:
+                result.append(region)
+                active.append(region)
+        merged = result
+    return merged
+
+
+def score_regions(regions, prod_index, hml_index, max_regions=MAX_REGIONS):
+    """Ordena as regiões pela quantidade de mudança e calcula os scores de cada uma"""
+    total_changed = sum(r['changed_pixels'] for r in regions) or 1
+    regions = sorted(regions, key=lambda r: r['changed_pixels'], reverse=True)[:max_regions]
+    for number, region in enumerate(regions, 1):
+        region['index'] = number
+        # Densidade: fração da caixa que mudou; participação: fração de toda a mudança da página
+        region['score'] = round(region['changed_pixels'] / (region['width'] * region['height']), 4)
+        region['share'] = round(region['changed_pixels'] / total_changed, 4)
+        # Linha correspondente em cada screenshot original (None se a faixa só existe do outro lado)
+        rows = slice(region['y'], region['y'] + region['height'])
+        for env, index in (('prod', prod_index), ('hml', hml_index)):
+            present = index[rows][index[rows] >= 0]
+            region[f'{env}_y'] = int(present[0]) if len(present) else None
+    return regions
+
+
+def draw_regions(comparison, regions, width, y_offset=0, separator_width=20):
+    """Desenha as caixas das regiões nos dois lados da composição (coordenadas da faixa)"""
+    for region in regions:
+        y0 = region['y'] - y_offset
+        y1 = y0 + region['height']
+        if y1 < 0 or y0 >= comparison.shape[0]:
+            continue
+        for x_offset in (0, width + separator_width):
+            x0 = region['x'] + x_offset
+            cv2.rectangle(comparison, (x0, y0), (x0 + region['width'] - 1, y1 - 1), (0, 0, 255), 2)
+
+
+def save_region_crops(prod_img, hml_img, prod_index, hml_index, regions, base, ext,
+                      margin=20, max_width=REGION_THUMBNAIL_WIDTH):
+    """Grava um recorte lado a lado (produção | homologação) de cada região"""
+    images = []
+    total_rows = len(prod_index)
+    for region in regions:
+        y0 = max(0, region['y'] - margin)
+        y1 = min(total_rows, region['y'] + region['height'] + margin)
+        x0 = max(0, region['x'] - margin)
+        x1 = min(prod_img.shape[1], region['x'] + region['width'] + margin)
+        prod_crop = aligned_strip(prod_img, prod_index[y0:y1])[:, x0:x1]
+        hml_crop = aligned_strip(hml_img, hml_index[y0:y1])[:, x0:x1]
+        crop = np.hstack([prod_crop, np.full((y1 - y0, 6, 3), 128, dtype=np.uint8), hml_crop])
+        if crop.shape[1] > max_width:
+            scale = max_width / crop.shape[1]
+            crop = cv2.resize(crop, (max_width, max(1, int(crop.shape[0] * scale))), interpolation=cv2.INTER_AREA)
+        path = f"{base}_region_{region['index']:02d}{ext}"
+        cv2.imwrite(path, crop)
+        region['image'] = os.path.basename(path)
+        images.append(region['image'])
+    return images
+
+
+def state_separator(states, width=20):
+    """Separador entre as colunas: cinza onde as linhas são iguais, vermelho onde mudaram"""
+    separator = np.full((len(states), width, 3), 128, dtype=np.uint8)
+    separator[states != ROW_EQUAL] = (0, 0, 255)
+    return separator
+
+
+def prepare_alignment(prod_img, hml_img):
+    """Coloca a homologação na largura da produção e alinha as linhas das duas imagens"""
+    width = prod_img.shape[1]
+    if hml_img.shape[1] != width:
+        height = max(1, int(round(hml_img.shape[0] * width / hml_img.shape[1])))
+        hml_img = cv2.resize(hml_img, (width, height))
+    prod_index, hml_index, states = align_rows(row_hashes(prod_img), row_hashes(hml_img))
+    return hml_img, prod_index, hml_index, states
+
+
+class HostConnectivity:
+    """Cache de conectividade por host, compartilhado entre descoberta e captura
+    
+    Guarda qual protocolo funciona e o estado de um circuit breaker: depois de
+    'failure_threshold' falhas seguidas o host é pulado por 'reset_timeout' segundos,
+    e então uma única tentativa decide se o circuito fecha ou abre de novo.
+    Todas as requisições usam uma requests.Session com pool de conexões.
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=60, timeout=5, pool_size=20):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.timeout = timeout
+        
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        
+        self._lock = threading.Lock()
+        self._hosts = {}
+        self._detect_locks = {}
+
+    def state(self, host):
+        with self._lock:
+            return self._hosts.setdefault(host.lower(), {
+                'scheme': None,
+                'failures': 0,
+                'open_until': 0.0,
+                'probe': None,
+                'last_error': None,
+            })
+
+    def _probe(self, url):
+        """HEAD leve; cai para GET sem baixar o corpo se o servidor não aceitar HEAD"""
+        response = self.session.head(url, timeout=self.timeout, verify=False, allow_redirects=True)
+        if response.status_code in (405, 501):
+            response = self.session.get(url, timeout=self.timeout, verify=False, stream=True)
+            response.close()
+        return response
+
+    def detect_protocol(self, domain):
+        """Detecta (uma única vez por host) se o domínio usa HTTP ou HTTPS"""
+        host = domain.lower()
+        with self._lock:
+            detect_lock = self._detect_locks.setdefault(host, threading.Lock())
+        
+        # Evita que vários workers façam a mesma detecção ao mesmo tempo
+        with detect_lock:
+            state = self.state(host)
+            if state['scheme']:
+                return state['scheme']
+            
+            for scheme in ('https', 'http'):
+                try:
+                    response = self._probe(f"{scheme}://{domain}")
+                except requests.RequestException as e:
+                    state['last_error'] = str(e)
+                    continue
+                if response.status_code < 400:
+                    state['scheme'] = scheme
+                    self.record_success(host)
+                    return scheme
+                state['last_error'] = f"HTTP {response.status_code}"
+            
+            # Se ambos falharem, assume HTTPS como padrão (sem cachear, para tentar de novo depois)
+            self.record_failure(host, state['last_error'])
+            return "https"
+
+    def known_scheme(self, host):
+        return self.state(host)['scheme']
+
+    def set_scheme(self, host, scheme):
+        """Registra um protocolo já conhecido (esquema explícito no domínio ou navegação bem-sucedida)"""
+        state = self.state(host)
+        with self._lock:
+            state['scheme'] = scheme
+
+    def allow(self, host):
+        """Diz se uma requisição para o host pode ser feita agora (circuito fechado ou meio aberto)
+        
+        Com o circuito meio aberto, devolve o token da única tentativa de teste liberada (valor
+        verdadeiro); é ele que release_probe() exige para liberar o teste.
+        """
+        state = self.state(host)
+        with self._lock:
+            if state['failures'] < self.failure_threshold:
+                return True
+            if time.time() < state['open_until']:
+                return False
+            if state['probe'] is not None:
+                # Já existe uma tentativa de teste em andamento
+                return False
+            state['probe'] = object()
+            return state['probe']
+
+    def release_probe(self, host, token):
+        """Libera a tentativa de teste do circuito meio aberto sem contar sucesso nem falha
+        
+        Para tentativas que terminam antes de chegar ao host (ex.: erro ao abrir a página);
+        sem isso o host ficaria bloqueado até o fim da execução. Só o dono do teste (o token
+        devolvido por allow()) o libera: uma tentativa liberada com o circuito fechado não pode
+        apagar o teste de outra e deixar passar um segundo teste simultâneo.
+        """
+        state = self.state(host)
+        with self._lock:
+            if token is not True and state['probe'] is token:
+                state['probe'] = None
+
+    def record_success(self, host):
+        state = self.state(host)
+        with self._lock:
+            state['failures'] = 0
+            state['probe'] = None
+            state['open_until'] = 0.0
+            state['last_error'] = None
+
+    def record_failure(self, host, error=None):
+        state = self.state(host)
+        with self._lock:
+            state['failures'] += 1
+            state['last_error'] = str(error) if error else state['last_error']
+            state['probe'] = None
+            if state['failures'] >= self.failure_threshold:
+                state['open_until'] = time.time() + self.reset_timeout
+                opened = True
+            else:
+                opened = False
+        if opened:
+            print(f"  🔌 Circuito aberto para {host} após {state['failures']} falhas; "
+                  f"pulando por {self.reset_timeout}s ({state['last_error']})")
+
+
+class HostRateLimiter:
+    """Controle adaptativo de taxa e concorrência por host, usado pela descoberta e pela captura
+    
+    Cada host tem um token bucket (requisições/s) e um limite de requisições simultâneas,
+    ajustados por AIMD: a cada rodada de 'limit' respostas boas os dois sobem (dobram enquanto
+    o host nunca reclamou, depois crescem aos poucos); um erro, 429/5xx ou latência acima de
+    'latency_factor' vezes a melhor já vista corta os dois pela metade. Assim a produção
+    (CDN) sobe até o teto e a homologação se estabiliza no que aguenta sem devolver 5xx.
+    """
+
+    THROTTLE_STATUSES = (429, 502, 503, 504)
+
+    def __init__(self, max_concurrency=4, max_rate=None, initial_rate=2.0, rate_step=0.5,
+                 decrease_factor=0.5, latency_factor=2.0):
+        self.max_concurrency = max(1, max_concurrency)
+        # Sem teto explícito a taxa fica limitada só pela concorrência
+        self.max_rate = max_rate or 100.0
+        self.initial_rate = min(initial_rate, self.max_rate)
+        self.rate_step = rate_step
+        self.decrease_factor = decrease_factor
+        self.latency_factor = latency_factor
+        self._hosts = {}
+
+    def state(self, host):
+        return self._hosts.setdefault(host.lower(), {
+            'rate': self.initial_rate,
+            'limit': 1,
+            'tokens': 1.0,
+            'refilled': time.monotonic(),
+            'in_flight': 0,
+            'slow_start': True,
+            'round': 0,
+            'latency_ewma': None,
+            'latency_best': None,
+            'last_decrease': 0.0,
+            'requests': 0,
+            'errors': 0,
+            'throttled': 0,
+            'decreases': 0,
+            'waited': 0.0,
+            'first_start': None,
+            'last_end': None,
+            'peak_rate': self.initial_rate,
+            'peak_limit': 1,
+        })
+
+    def _refill(self, state, now):
+        # Rajada de até 'limit' requisições: o bucket não acumula além da concorrência permitida
+        state['tokens'] = min(max(1.0, state['limit']),
+                              state['tokens'] + (now - state['refilled']) * state['rate'])
+        state['refilled'] = now
+
+    async def acquire(self, host):
+        state = self.state(host)
+        started = time.monotonic()
+        while True:
+            now = time.monotonic()
+            self._refill(state, now)
+            if state['in_flight'] < state['limit'] and state['tokens'] >= 1:
+                state['tokens'] -= 1
+                state['in_flight'] += 1
+                state['waited'] += now - started
+                if state['first_start'] is None:
+                    state['first_start'] = now
+                return
+            wait = (1 - state['tokens']) / state['rate'] if state['tokens'] < 1 else 0.05
+            await asyncio.sleep(max(0.01, wait))
+
+    @classmethod
+    def is_throttled(cls, status):
+        return status in cls.THROTTLE_STATUSES or (status is not None and status >= 500)
+
+    def release(self, host, latency, status=None, error=None):
+        """Registra o fim de uma requisição e ajusta taxa e concorrência do host"""
+        state = self.state(host)
+        now = time.monotonic()
+        # Só cresce se o limite atual estava em uso; senão a vaga extra nunca foi testada
+        saturated = state['in_flight'] >= state['limit']
+        state['in_flight'] -= 1
+        state['requests'] += 1
+        state['last_end'] = now
+        
+        throttled = self.is_throttled(status)
+        if error is not None:
+            state['errors'] += 1
+        elif throttled:
+            state['throttled'] += 1
+        else:
+            ewma = state['latency_ewma']
+            state['latency_ewma'] = latency if ewma is None else 0.8 * ewma + 0.2 * latency
+            best = state['latency_best']
+            state['latency_best'] = state['latency_ewma'] if best is None else min(best, state['latency_ewma'])
+        
+        slow = (state['latency_best'] is not None and
+                state['latency_ewma'] > state['latency_best'] * self.latency_factor)
+        if error is not None or throttled or slow:
+            self._decrease(host, state, now, 'erro' if error is not None else status if throttled else 'latência')
+        elif saturated or state['tokens'] < 1:
+            self._increase(state)
+
+    def _decrease(self, host, state, now, reason):
+        # Várias respostas ruins da mesma rajada (uma latência) contam como um único sinal
+        window = state['latency_ewma'] or 1.0
+        if now - state['last_decrease'] < window:
+            return
+        state['last_decrease'] = now
+        state['slow_start'] = False
+        state['round'] = 0
+        state['decreases'] += 1
+        state['rate'] = max(0.2, state['rate'] * self.decrease_factor)
+        state['limit'] = max(1, int(state['limit'] * self.decrease_factor))
+        if state['latency_best'] is not None and reason == 'latência':
+            # A página mais rápida já vista não vale como referência para sempre
+            state['latency_best'] = state['latency_ewma'] / self.latency_factor
+        print(f"  🐢 {host}: reduzindo para {state['rate']:.1f} req/s e {state['limit']} simultâneas ({reason})")
+
+    def _increase(self, state):
+        state['round'] += 1
+        if state['round'] < state['limit']:
+            return
+        state['round'] = 0
+        if state['slow_start']:
+            state['rate'] = min(self.max_rate, state['rate'] * 2)
+            state['limit'] = min(self.max_concurrency, state['limit'] * 2)
+        else:
+            state['rate'] = min(self.max_rate, state['rate'] + self.rate_step)
+            state['limit'] = min(self.max_concurrency, state['limit'] + 1)
+        state['peak_rate'] = max(state['peak_rate'], state['rate'])
+        state['peak_limit'] = max(state['peak_limit'], state['limit'])
+
+    @asynccontextmanager
+    async def slot(self, host):
+        """Reserva uma vaga no host; o bloco pode preencher outcome['status'] com o código HTTP"""
+        await self.acquire(host)
+        outcome = {'status': None}
+        started = time.monotonic()
+        error = None
+        cancelled = False
+        try:
+            yield outcome
+        except Exception as e:
+            error = e
+            raise
+        except BaseException:
+            # Cancelamento (fim da execução, caminho rápido) não é sinal do host para o AIMD
+            cancelled = True
+            raise
+        finally:
+            # Sempre devolve a vaga, senão o host perde concorrência a cada cancelamento
+            if cancelled:
+                self.state(host)['in_flight'] -= 1
+            else:
+                self.release(host, time.monotonic() - started, outcome['status'], error)
+
+    async def goto(self, page, url, retries=3, **options):
+        """Navega pela vaga do host, repetindo em 429/5xx em vez de devolver a página de erro
+        
+        Cada resposta de throttling já reduz taxa e concorrência do host; entre as tentativas
+        espera o Retry-After (ou um backoff exponencial). Esgotadas as tentativas, levanta
+        RuntimeError: a página de erro nunca deve virar screenshot.
+        """
+        host = urlparse(url).netloc
+        for attempt in range(retries + 1):
+            async with self.slot(host) as request:
+                response = await page.goto(url, **options)
+                request['status'] = response.status if response else None
+            if not self.is_throttled(request['status']):
+                return response
+            if attempt < retries:
+                try:
+                    delay = float(response.headers.get('retry-after', ''))
+                except ValueError:
+                    delay = 2 ** attempt
+                print(f"    🐢 HTTP {request['status']} em {url}; nova tentativa em {min(delay, 30):.0f}s")
+                await asyncio.sleep(min(delay, 30))
+        raise RuntimeError(f"HTTP {request['status']} após {retries + 1} tentativas (host sobrecarregado)")
+
+    def stats(self):
+        """Taxas efetivas por host (requisições concluídas / tempo entre a primeira e a última)"""
+        stats = {}
+        for host, state in self._hosts.items():
+            if not state['requests']:
+                continue
+            active = (state['last_end'] - state['first_start']) if state['first_start'] is not None else 0
+            stats[host] = {
+                'requests': state['requests'],
+                'errors': state['errors'],
+                'throttled': state['throttled'],
+                'effective_rate': state['requests'] / active if active > 0 else 0.0,
+                'rate': state['rate'],
+                'limit': state['limit'],
+                'peak_rate': state['peak_rate'],
+                'peak_limit': state['peak_limit'],
+                'decreases': state['decreases'],
+                'latency_ms': (state['latency_ewma'] or 0) * 1000,
+                'waited_seconds': state['waited'],
+            }
+        return stats
+
+
+class SiteCrawler:
+    """Descobre páginas de um domínio: primeiro via robots.txt/sitemap.xml, depois renderizando links"""
+
+    def __init__(self, domain, protocol, max_pages, concurrency=4, wait_until='load', connectivity=None,
+                 interceptor=None, timer=None, rate_limiter=None):
+        self.domain = domain
+        self.protocol = protocol
+        self.max_pages = max_pages
+        self.concurrency = max(1, concurrency)
+        self.wait_until = wait_until
+        self.connectivity = connectivity or HostConnectivity()
+        self.session = self.connectivity.session
+        self.interceptor = interceptor
+        self.timer = timer or StageTimer()
+        self.rate_limiter = rate_limiter or HostRateLimiter(max_concurrency=self.concurrency)
+        self.base_url = f"{protocol}://{domain}"
+        
+        self.frontier = deque()
+        self.seen = set()        # URLs canônicas já enfileiradas ou visitadas
+        self.found = []          # Páginas encontradas, na ordem de descoberta
+        self._found_set = set()
+
+    def canonical(self, url):
+        return canonicalize_url(url, scheme=self.protocol)
+
+    def is_candidate(self, url):
+        """Verifica se a URL pertence ao domínio e parece ser uma página HTML"""
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https'):
+            return False
+        if not parsed.netloc.lower().endswith(self.domain.lower()):
+            return False
+        return not parsed.path.lower().endswith(SKIPPED_EXTENSIONS)
+
+    def enqueue(self, url):
+        canonical = self.canonical(url)
+        if canonical in self.seen or not self.is_candidate(canonical):
+            return False
+        self.seen.add(canonical)
+        self.frontier.append(canonical)
+        return True
+
+    def add_found(self, url):
+        canonical = self.canonical(url)
+        if canonical in self._found_set or len(self.found) >= self.max_pages:
+            return False
+        self._found_set.add(canonical)
+        self.found.append(canonical)
+        return True
+
+    # --- Semeadura via HTTP simples ---
+
+    def _fetch_text(self, url):
+        try:
+            response = self.session.get(url, timeout=10, verify=False)
+        except requests.RequestException:
+            return None
+        if response.status_code != 200:
+            return None
+        content = response.content
+        # Sitemaps podem vir compactados (.xml.gz)
+        if content[:2] == b'\x1f\x8b':
+            try:
+                content = gzip.decompress(content)
+            except OSError:
+                return None
+        return content
+
+    def sitemap_urls_from_robots(self):
+        """Lê as diretivas 'Sitemap:' do robots.txt"""
+        content = self._fetch_text(f"{self.base_url}/robots.txt")
+        if not content:
+            return []
+        sitemaps = []
+        for line in content.decode('utf-8', errors='ignore').splitlines():
+            key, _, value = line.partition(':')
+            if key.strip().lower() == 'sitemap' and value.strip():
+                sitemaps.append(value.strip())
+        return sitemaps
+
+    def seed_from_sitemaps(self, max_sitemaps=20):
+        """Preenche a fronteira com as URLs listadas nos sitemaps, sem renderizar nada"""
+        sitemaps = deque(self.sitemap_urls_from_robots() or [f"{self.base_url}/sitemap.xml"])
+        fetched = set()
+        seeded = 0
+        
+        while sitemaps and len(fetched) < max_sitemaps and len(self.found) < self.max_pages:
+            sitemap_url = sitemaps.popleft()
+            if sitemap_url in fetched:
+                continue
+            fetched.add(sitemap_url)
+            
+            content = self._fetch_text(sitemap_url)
+            if not content:
+                continue
+            try:
+                root = ET.fromstring(content)
+            except ET.ParseError:
+                continue
+            
+            # Ignora namespaces: <urlset>/<url>/<loc> e <sitemapindex>/<sitemap>/<loc>
+            is_index = root.tag.endswith('sitemapindex')
+            for element in root.iter():
+                if not element.tag.endswith('loc') or not element.text:
+                    continue
+                loc = element.text.strip()
+                if is_index:
+                    sitemaps.append(loc)
+                elif self.enqueue(loc) and self.add_found(loc):
+                    seeded += 1
+                    if len(self.found) >= self.max_pages:
+                        break
+        
+        if seeded:
+            print(f"  🗺️  {seeded} páginas encontradas via sitemap")
+        return seeded
+
+    # --- Crawling renderizado ---
+
+    async def crawl(self, browser):
+        """Extrai links renderizando páginas com vários workers concorrentes"""
+        with self.timer.span('discover.sitemap', env='prod'):
+            await asyncio.to_thread(self.seed_from_sitemaps)
+        
+        # A página inicial sempre é a primeira visitada, mesmo que o sitemap não a liste
+        home = self.canonical(self.base_url)
+        if home in self.seen:
+            self.frontier.remove(home)
+        self.seen.add(home)
+        self.frontier.appendleft(home)
+        
+        if len(self.found) >= self.max_pages:
+            return self.found
+        
+        context = await browser.new_context(ignore_https_errors=True)
+        if self.interceptor:
+            await self.interceptor.attach(context)
+        active = 0
+        
+        async def worker():
+            nonlocal active
+            page = await context.new_page()
+            try:
+                while len(self.found) < self.max_pages:
+                    if not self.frontier:
+                        # Fronteira vazia: termina se ninguém mais pode adicionar links
+                        if active == 0:
+                            return
+                        await asyncio.sleep(0.05)
+                        continue
+                    
+                    current_url = self.frontier.popleft()
+                    active += 1
+                    try:
+                        with self.timer.span('discover.visit', env='prod'):
+                            await self._visit(page, current_url)
+                    finally:
+                        active -= 1
+            finally:
+                await page.close()
+        
+        try:
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        finally:
+            await context.close()
+        
+        return self.found
+
+    async def _visit(self, page, current_url):
+        host = urlparse(current_url).netloc
+        if not self.connectivity.allow(host):
+            return
+        try:
+            print(f"  Analisando: {current_url}")
+            try:
+                await self.rate_limiter.goto(page, current_url, wait_until=self.wait_until, timeout=30000)
+            except Exception as e:
+                self.connectivity.record_failure(host, e)
+                raise
+            self.connectivity.record_success(host)
+            self.add_found(current_url)
+            
+            links = await page.eval_on_selector_all('a[href]', 'elements => elements.map(el => el.href)')
+            for link in links:
+                self.enqueue(urljoin(current_url, link))
+        except Exception as e:
+            print(f"  ❌ Erro ao acessar {current_url}: {e}")
+
+
+class ScreenshotWriter:
+    """Grava os screenshots brutos em segundo plano, fora do caminho da captura e do diff"""
+
+    def __init__(self, image_format='png', compression=None, max_workers=2, timer=None):
+        self.image_format = image_format.lower()
+        if self.image_format not in ('png', 'webp'):
+            raise ValueError(f"Formato de screenshot não suportado: {image_format}")
+        self.compression = compression
+        self.timer = timer or StageTimer()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='screenshot-writer')
+
+    @property
+    def extension(self):
+        return f".{self.image_format}"
+
+    def encode(self, png_bytes):
+        """Converte o PNG do navegador para o formato configurado"""
+        # PNG sem nível definido: grava os bytes do navegador como estão, sem decodificar
+        if self.image_format == 'png' and self.compression is None:
+            return png_bytes
+        
+        image = load_image(png_bytes)
+        if self.image_format == 'webp':
+            params = [cv2.IMWRITE_WEBP_QUALITY, 101]  # Acima de 100 = WebP sem perdas
+        else:
+            params = [cv2.IMWRITE_PNG_COMPRESSION, int(self.compression)]
+        ok, encoded = cv2.imencode(self.extension, image, params)
+        if not ok:
+            raise ValueError(f"Falha ao codificar screenshot como {self.image_format}")
+        return encoded.tobytes()
+
+    def _write(self, png_bytes, path, page=None, env=None):
+        with self.timer.span('save.encode', page, env):
+            data = self.encode(png_bytes)
+        # Grava em arquivo temporário para nunca deixar um screenshot pela metade
+        with self.timer.span('save.write', page, env):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+    def save(self, png_bytes, path, page=None, env=None):
+        future = self._executor.submit(self._write, png_bytes, path, page, env)
+        future.add_done_callback(
+            lambda f: f.exception() and print(f"    ⚠️  Erro ao salvar {path}: {f.exception()}")
+        )
+        return future
+
+    def close(self):
+        """Espera as gravações pendentes terminarem"""
+        self._executor.shutdown(wait=True)
+
+
+class PageReadiness:
+    """Espera adaptativa até a página ficar pronta para o screenshot
+    
+    Cada fase tem um limite superior (ms) e termina assim que a condição é atendida.
+    O tempo real gasto em cada fase é devolvido por wait() para entrar no relatório.
+    """
+
+    SCROLL_SCRIPT = """
+        async (maxSteps) => {
+            // Dois frames garantem que os callbacks de IntersectionObserver já rodaram
+            const nextFrame = () => new Promise(r => requestAnimationFrame(() => requestAnimationFrame(r)));
+            document.querySelectorAll('img[loading="lazy"]').forEach(img => { img.loading = 'eager'; });
+            let steps = 0;
+            while (steps < maxSteps) {
+                const before = window.scrollY;
+                window.scrollBy(0, window.innerHeight);
+                await nextFrame();
+                steps++;
+                const bottom = window.scrollY + window.innerHeight >= document.documentElement.scrollHeight;
+                if (bottom || window.scrollY === before) break;
+            }
+            window.scrollTo(0, 0);
+            await nextFrame();
+            return steps;
+        }
+    """
+
+    IMAGES_SCRIPT = """
+        async (timeout) => {
+            const pending = [...document.images].filter(img => img.currentSrc || img.src).map(img =>
+                img.complete
+                    ? (img.decode ? img.decode().catch(() => {}) : null)
+                    : new Promise(r => {
+                        img.addEventListener('load', r, {once: true});
+                        img.addEventListener('error', r, {once: true});
+                    })
+            );
+            await Promise.race([Promise.all(pending), new Promise(r => setTimeout(r, timeout))]);
+            return pending.length;
+        }
+    """
+
+    FONTS_SCRIPT = """
+        async (timeout) => {
+            await Promise.race([document.fonts.ready, new Promise(r => setTimeout(r, timeout))]);
+            return document.fonts.status;
+        }
+    """
+
+    LAYOUT_SCRIPT = """
+        ({quietMs, timeout}) => new Promise(resolve => {
+            const start = performance.now();
+            let last = start;
+            let height = document.documentElement.scrollHeight;
+            const bump = () => { last = performance.now(); };
+            const mutations = new MutationObserver(bump);
+            mutations.observe(document.documentElement, {childList: true, subtree: true, characterData: true});
+            const resizes = new ResizeObserver(bump);
+            resizes.observe(document.documentElement);
+            if (document.body) resizes.observe(document.body);
+            const tick = () => {
+                const currentHeight = document.documentElement.scrollHeight;
+                if (currentHeight !== height) { height = currentHeight; bump(); }
+                const now = performance.now();
+                if (now - last >= quietMs || now - start >= timeout) {
+                    mutations.disconnect();
+                    resizes.disconnect();
+                    resolve(now - last >= quietMs ? 'stable' : 'timeout');
+                } else {
+                    setTimeout(tick, 50);
+                }
+            };
+            setTimeout(tick, 50);
+        })
+    """
+
+    def __init__(self, network_idle_timeout=5000, max_scroll_steps=60, images_timeout=5000,
+                 fonts_timeout=3000, stability_quiet_ms=500, stability_timeout=5000):
+        self.network_idle_timeout = network_idle_timeout
+        self.max_scroll_steps = max_scroll_steps
+        self.images_timeout = images_timeout
+        self.fonts_timeout = fonts_timeout
+        self.stability_quiet_ms = stability_quiet_ms
+        self.stability_timeout = stability_timeout
+
+    async def wait(self, page):
+        """Executa as fases em ordem e devolve quanto tempo (ms) cada uma levou"""
+        timings = {}
+        started = time.perf_counter()
+        
+        async def phase(name, action):
+            phase_start = time.perf_counter()
+            try:
+                result = await action
+            except Exception:
+                # Estourar o limite de uma fase não impede o screenshot
+                result = 'timeout'
+            timings[name] = round((time.perf_counter() - phase_start) * 1000)
+            return result
+        
+        await phase('network_idle', page.wait_for_load_state('networkidle', timeout=self.network_idle_timeout))
+        timings['scroll_steps'] = await phase('scroll', page.evaluate(self.SCROLL_SCRIPT, self.max_scroll_steps))
+        await phase('images', page.evaluate(self.IMAGES_SCRIPT, self.images_timeout))
+        await phase('fonts', page.evaluate(self.FONTS_SCRIPT, self.fonts_timeout))
+        timings['layout_state'] = await phase('layout', page.evaluate(
+            self.LAYOUT_SCRIPT, {'quietMs': self.stability_quiet_ms, 'timeout': self.stability_timeout}
+        ))
+        
+        timings['total'] = round((time.perf_counter() - started) * 1000)
+        return timings
+
+
+class DomFingerprint:
+    """Impressão digital da página renderizada, para pular screenshot e diff de pares iguais
+    
+    Combina o DOM serializado (com os nós dinâmicos mascarados e a origem removida, para que
+    produção e homologação sejam comparáveis), as regras CSS acessíveis, o hash do conteúdo de
+    cada folha de estilo, fonte e imagem baixada e o tamanho da viewport e do documento.
+    Páginas com conteúdo que não aparece no DOM (canvas, vídeo, iframes, shadow DOM) não
+    recebem impressão digital e seguem sempre pelo screenshot.
+    """
+
+    HASHED_TYPES = ('stylesheet', 'font', 'image', 'media')
+    UNSUPPORTED_SELECTOR = 'canvas, video, iframe, embed, object'
+
+    SERIALIZE_SCRIPT = """
+        ({maskSelectors, unsupported}) => {
+            if (document.querySelector(unsupported)) return null;
+            if ([...document.querySelectorAll('*')].some(el => el.shadowRoot)) return null;
+            const root = document.documentElement.cloneNode(true);
+            for (const selector of maskSelectors) {
+                let nodes;
+                try { nodes = root.querySelectorAll(selector); } catch (e) { continue; }
+                nodes.forEach(node => {
+                    for (const attr of [...node.attributes]) node.setAttribute(attr.name, '');
+                    node.textContent = '';
+                });
+            }
+            // Regras inseridas via CSSOM (CSS-in-JS) não aparecem no HTML; folhas de outra origem
+            // não são legíveis aqui e entram pelo hash do conteúdo baixado
+            const sheets = [...document.styleSheets].map(sheet => {
+                try { return [...sheet.cssRules].map(rule => rule.cssText).join('\\n'); }
+                catch (e) { return null; }
+            }).filter(text => text !== null);
+            const strip = text => text.split(location.origin).join('').split(location.host).join('');
+            return {
+                html: strip(root.outerHTML),
+                sheets: sheets.map(strip),
+                width: document.documentElement.scrollWidth,
+                height: document.documentElement.scrollHeight,
+            };
+        }
+    """
+
+    def __init__(self, mask_selectors=DEFAULT_FINGERPRINT_MASK_SELECTORS,
+                 mask_patterns=DEFAULT_FINGERPRINT_MASK_PATTERNS, assets_timeout=5000, pair_timeout=30000):
+        self.mask_selectors = list(mask_selectors)
+        self.mask_patterns = [re.compile(pattern) for pattern in mask_patterns]
+        # Limites (ms) para os corpos dos assets (streams nunca terminam) e para o outro ambiente
+        self.assets_timeout = assets_timeout
+        self.pair_timeout = pair_timeout
+
+    def watch(self, page):
+        """Começa a registrar os hashes dos assets; precisa ser chamado antes do goto"""
+        pending = []
+        
+        async def digest(response):
+            try:
+                body = await response.body()
+            except Exception:
+                return None
+            return hashlib.blake2b(body, digest_size=16).hexdigest()
+        
+        def on_response(response):
+            if response.request.resource_type in self.HASHED_TYPES and response.ok:
+                pending.append(asyncio.ensure_future(digest(response)))
+        
+        page.on('response', on_response)
+        return pending
+
+    def mask(self, text):
+        for pattern in self.mask_patterns:
+            text = pattern.sub('•', text)
+        return text
+
+    async def compute(self, page, pending):
+        """Devolve o hash da página ou None se ela não pode ser comparada só pelo DOM"""
+        snapshot = await page.evaluate(self.SERIALIZE_SCRIPT, {
+            'maskSelectors': self.mask_selectors, 'unsupported': self.UNSUPPORTED_SELECTOR,
+        })
+        if snapshot is None:
+            return None
+        try:
+            assets = await asyncio.wait_for(asyncio.gather(*pending), self.assets_timeout / 1000)
+        except asyncio.TimeoutError:
+            return None
+        if None in assets:
+            return None
+        payload = {
+            'html': self.mask(snapshot['html']),
+            'sheets': [self.mask(sheet) for sheet in snapshot['sheets']],
+            # A ordem de chegada dos assets varia entre execuções; o conjunto é o que importa
+            'assets': sorted(assets),
+            'viewport': page.viewport_size,
+            'document': [snapshot['width'], snapshot['height']],
+        }
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+    async def matches(self, fingerprints, env, fingerprint):
+        """Publica a impressão digital deste ambiente e diz se a do outro é igual
+        
+        Se o outro ambiente demorar mais que 'pair_timeout', este desiste e marca o par para
+        que o outro também tire o screenshot ao publicar a sua mais tarde.
+        """
+        fingerprints[env].set_result(fingerprint)
+        if not fingerprint:
+            return False
+        other = 'hml' if env == 'prod' else 'prod'
+        try:
+            # shield: o timeout não pode cancelar a future que o outro lado ainda vai preencher
+            other_fingerprint = await asyncio.wait_for(asyncio.shield(fingerprints[other]),
+                                                       self.pair_timeout / 1000)
+        except asyncio.TimeoutError:
+            fingerprints['gave_up'] = True
+            return False
+        return other_fingerprint == fingerprint and not fingerprints.get('gave_up')
+
+
+def peak_rss():
+    """Pico de memória residente do processo atual, em bytes (None sem o módulo resource, ex.: Windows)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux informa em KB, macOS em bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def freshness_lifetime(headers):
+    """Tempo (s) em que um asset pode ser servido do cache sem revalidar; None = não cachear"""
+    cache_control = headers.get('cache-control', '').lower()
+    directives = {}
+    for part in cache_control.split(','):
+        key, _, value = part.strip().partition('=')
+        directives[key] = value.strip('"')
+    
+    if 'no-store' in directives or ('private' in directives and 'max-age' not in directives):
+        return None
+    if 'no-cache' in directives:
+        return 0
+    if 'max-age' in directives:
+        try:
+            return max(0, int(directives['max-age']))
+        except ValueError:
+            return 0
+    if 'expires' in headers:
+        try:
+            expires = parsedate_to_datetime(headers['expires']).timestamp()
+        except (TypeError, ValueError):
+            return 0
+        return max(0, int(expires - time.time()))
+    # Sem indicação de validade: guarda, mas sempre revalida antes de usar
+    return 0
+
+
+class AssetCache:
+    """Cache em disco de assets estáticos (CSS, JS, fontes, imagens) compartilhado entre contextos
+    
+    O índice SQLite mapeia URL -> hash do conteúdo; os corpos ficam em arquivos endereçados pelo
+    hash, então o mesmo arquivo servido em várias URLs ocupa espaço uma vez só. Acima de
+    'max_bytes' os menos usados recentemente são removidos.
+    
+    A validade (max-age/Expires) só vale dentro da execução: uma entrada validada numa execução
+    anterior é revalidada antes do primeiro uso, senão um bundle sem versão no nome alterado
+    por um deploy seria servido da cópia antiga e a diferença sumiria do relatório.
+    """
+
+    # Cabeçalhos que não valem para o corpo já decodificado guardado no cache
+    DROPPED_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding', 'set-cookie')
+
+    def __init__(self, cache_dir, max_bytes=1024 ** 3):
+        self.cache_dir = cache_dir
+        self.blobs_dir = os.path.join(cache_dir, 'blobs')
+        self.max_bytes = max_bytes
+        self.run_started = time.time()
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(cache_dir, 'index.sqlite'), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS assets (
+                    url TEXT PRIMARY KEY,
+                    hash TEXT NOT NULL,
+                    status INTEGER NOT NULL,
+                    headers TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_used_at REAL NOT NULL,
+                    validated_at REAL NOT NULL DEFAULT 0
+                )
+            """)
+            columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(assets)")}
+            if 'validated_at' not in columns:
+                # Índice de uma versão anterior: todas as entradas passam a ser revalidadas
+                self._conn.execute("ALTER TABLE assets ADD COLUMN validated_at REAL NOT NULL DEFAULT 0")
+            self._total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM assets").fetchone()[0]
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blobs_dir, digest[:2], digest)
+
+    def get(self, url):
+        """Devolve (entrada, corpo) ou None; a entrada diz se ainda está fresca ('fresh')"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM assets WHERE url = ?", (url,)).fetchone()
+        if not row:
+            return None
+        try:
+            with open(self._blob_path(row['hash']), 'rb') as f:
+                body = f.read()
+        except OSError:
+            return None
+        entry = dict(row)
+        entry['headers'] = json.loads(entry['headers'])
+        entry['fresh'] = entry['expires_at'] > time.time() and entry['validated_at'] >= self.run_started
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE assets SET last_used_at = ? WHERE url = ?", (time.time(), url))
+        return entry, body
+
+    def put(self, url, status, headers, body):
+        lifetime = freshness_lifetime(headers)
+        if lifetime is None:
+            return
+        headers = {k: v for k, v in headers.items() if k.lower() not in self.DROPPED_HEADERS}
+        digest = content_hash(body)
+        blob_path = self._blob_path(digest)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            # Shards em processos diferentes compartilham o cache: o pid evita colisão entre eles
+            tmp_path = f"{blob_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(body)
+            os.replace(tmp_path, blob_path)
+        
+        now = time.time()
+        with self._lock, self._conn:
+            old = self._conn.execute("SELECT size FROM assets WHERE url = ?", (url,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO assets (url, hash, status, headers, size, expires_at, last_used_at, "
+                "validated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, digest, status, json.dumps(headers), len(body), now + lifetime, now, now)
+            )
+            self._total += len(body) - (old['size'] if old else 0)
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def refresh(self, url, headers):
+        """Renova a validade após uma revalidação com resposta 304"""
+        lifetime = freshness_lifetime(headers) or 0
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE assets SET expires_at = ?, last_used_at = ?, validated_at = ? WHERE url = ?",
+                               (now + lifetime, now, now, url))
+
+    def _evict(self):
+        """Remove os menos usados até ficar em 90% do limite (chamado com o lock)"""
+        target = self.max_bytes * 0.9
+        rows = self._conn.execute("SELECT url, hash, size FROM assets ORDER BY last_used_at").fetchall()
+        for row in rows:
+            if self._total <= target:
+                break
+            self._conn.execute("DELETE FROM assets WHERE url = ?", (row['url'],))
+            self._total -= row['size']
+            # O blob pode ser compartilhado por outra URL
+            still_used = self._conn.execute("SELECT 1 FROM assets WHERE hash = ? LIMIT 1", (row['hash'],)).fetchone()
+            if not still_used:
+                try:
+                    os.remove(self._blob_path(row['hash']))
+                except OSError:
+                    pass
+
+
+class RequestInterceptor:
+    """Camada de interceptação (page.route) aplicada a todos os contextos
+    
+    Bloqueia domínios de terceiros configurados e serve assets estáticos do AssetCache,
+    revalidando com ETag/Last-Modified quando a validade expira ou a entrada é de outra execução.
+    """
+
+    CACHEABLE_TYPES = ('stylesheet', 'script', 'font', 'image', 'media')
+
+    def __init__(self, asset_cache=None, blocked_domains=DEFAULT_BLOCKED_DOMAINS):
+        self.asset_cache = asset_cache
+        self.blocked_domains = tuple(d.lower().lstrip('.') for d in (blocked_domains or ()))
+        self.stats = {'blocked': 0, 'hits': 0, 'revalidated': 0, 'misses': 0, 'bytes_saved': 0}
+
+    async def attach(self, context):
+        if self.asset_cache or self.blocked_domains:
+            await context.route('**/*', self.handle)
+
+    def is_blocked(self, url):
+        host = (urlparse(url).hostname or '').lower()
+        return any(host == domain or host.endswith(f".{domain}") for domain in self.blocked_domains)
+
+    async def handle(self, route):
+        request = route.request
+        try:
+            if self.is_blocked(request.url):
+                self.stats['blocked'] += 1
+                await route.abort('blockedbyclient')
+                return
+            
+            if (not self.asset_cache or request.method != 'GET'
+                    or request.resource_type not in self.CACHEABLE_TYPES):
+                await route.continue_()
+                return
+            
+            await self._serve_cached(route, request)
+        except Exception:
+            # A interceptação nunca pode derrubar a página: em caso de erro segue sem cache
+            try:
+                await route.continue_()
+            except Exception:
+                pass
+
+    async def _serve_cached(self, route, request):
+        cached = await asyncio.to_thread(self.asset_cache.get, request.url)
+        if cached:
+            entry, body = cached
+            if entry['fresh']:
+                self.stats['hits'] += 1
+                self.stats['bytes_saved'] += len(body)
+                await route.fulfill(status=entry['status'], headers=entry['headers'], body=body)
+                return
+            
+            # Expirado: revalida com requisição condicional
+            conditional = dict(request.headers)
+            if entry['headers'].get('etag'):
+                conditional['if-none-match'] = entry['headers']['etag']
+            if entry['headers'].get('last-modified'):
+                conditional['if-modified-since'] = entry['headers']['last-modified']
+            response = await route.fetch(headers=conditional)
+            if response.status == 304:
+                self.stats['revalidated'] += 1
+                self.stats['bytes_saved'] += len(body)
+                await asyncio.to_thread(self.asset_cache.refresh, request.url, response.headers)
+                await route.fulfill(status=entry['status'], headers=entry['headers'], body=body)
+                return
+        else:
+            response = await route.fetch()
+        
+        self.stats['misses'] += 1
+        body = await response.body()
+        if response.status == 200:
+            await asyncio.to_thread(self.asset_cache.put, request.url, response.status, response.headers, body)
+        await route.fulfill(response=response, body=body)
+
+
+class ContextPool:
+    """Pool reutilizável de contextos do navegador para um ambiente (produção ou homologação)
+    
+    Produção e homologação visitam as páginas em ordens diferentes, então nenhum estado pode
+    passar de uma página para a próxima: service workers são bloqueados, cookies e storage são
+    limpos a cada uso e o contexto é trocado por um novo depois de 'max_uses' páginas.
+    """
+
+    CLEAR_STORAGE_SCRIPT = """
+        async () => {
+            try { localStorage.clear(); } catch (e) {}
+            try { sessionStorage.clear(); } catch (e) {}
+            try {
+                if (indexedDB.databases) {
+                    for (const db of await indexedDB.databases()) indexedDB.deleteDatabase(db.name);
+                }
+            } catch (e) {}
+            try {
+                if (self.caches) {
+                    for (const key of await caches.keys()) await caches.delete(key);
+                }
+            } catch (e) {}
+        }
+    """
+
+    def __init__(self, browser, size, interceptor=None, max_uses=50, **context_options):
+        self.browser = browser
+        self.size = size
+        self.interceptor = interceptor
+        self.max_uses = max_uses
+        self.context_options = {'service_workers': 'block', **context_options}
+        self._available = asyncio.Queue()
+        self._contexts = set()
+        self._uses = {}
+        self._reserved = 0
+
+    async def start(self, count=None):
+        """Cria contextos antecipadamente; os demais (até size) são criados sob demanda"""
+        for _ in range(self.size if count is None else min(count, self.size)):
+            self._reserved += 1
+            await self._add_context()
+
+    async def _add_context(self):
+        context = await self.browser.new_context(**self.context_options)
+        if self.interceptor:
+            await self.interceptor.attach(context)
+        self._contexts.add(context)
+        self._uses[context] = 0
+        self._available.put_nowait(context)
+
+    @classmethod
+    async def clear_storage(cls, page):
+        """Apaga localStorage, sessionStorage, IndexedDB e Cache Storage da origem da página
+        
+        Precisa rodar antes de fechar a página: sem uma página aberta na origem não há como limpar.
+        """
+        try:
+            await page.evaluate(cls.CLEAR_STORAGE_SCRIPT)
+        except Exception:
+            pass
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Empresta um contexto do pool e o devolve limpo ao final"""
+        if self._available.empty() and self._reserved < self.size:
+            # Reserva antes do await para que dois workers não passem do limite
+            self._reserved += 1
+            await self._add_context()
+        context = await self._available.get()
+        try:
+            yield context
+        finally:
+            try:
+                self._uses[context] += 1
+                if self._uses[context] >= self.max_uses:
+                    # Recicla: o que a limpeza não alcança (ex.: storage de iframes) não se acumula
+                    raise RuntimeError("contexto atingiu max_uses")
+                # Limpa o estado para que uma página não influencie a próxima
+                await context.clear_cookies()
+                self._available.put_nowait(context)
+            except Exception:
+                # Contexto reciclado ou corrompido (ex.: navegador travou): descarta e cria outro
+                self._contexts.discard(context)
+                self._uses.pop(context, None)
+                try:
+                    await context.close()
+                except Exception:
+                    pass
+                await self._add_context()
+
+    async def close(self):
+        for context in list(self._contexts):
+            try:
+                await context.close()
+            except Exception:
+                pass
+        self._contexts.clear()
+        self._uses.clear()
+
+
+class RunJournal:
+    """Diário append-only (JSONL) de uma execução, gravado no diretório de resultados
+    
+    Registra a configuração, a lista de páginas descobertas e o resultado de cada captura
+    e de cada diff. Cada linha é gravada e descarregada no disco na hora, então uma execução
+    interrompida (Ctrl-C, crash do navegador, OOM) pode ser retomada com --resume.
+    """
+
+    FILENAME = 'journal.jsonl'
+
+    def __init__(self, results_dir):
+        self.path = os.path.join(results_dir, self.FILENAME)
+        self._lock = threading.Lock()
+        # Fecha uma linha truncada pela interrupção anterior para não corromper a próxima
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            with open(self.path, 'rb+') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    f.write(b'\n')
+
+    @classmethod
+    def load(cls, results_dir):
+        """Reconstrói o estado a partir do diário: run, pages e resultados por índice"""
+        state = {'run': None, 'pages': None, 'hml_urls': {}, 'results': {}, 'captures': {}}
+        path = os.path.join(results_dir, cls.FILENAME)
+        if not os.path.exists(path):
+            return state
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Última linha truncada por uma interrupção no meio da escrita
+                    continue
+                kind = record.get('type')
+                if kind == 'run':
+                    state['run'] = record
+                elif kind == 'pages':
+                    state['pages'] = record['urls']
+                    state['hml_urls'] = record.get('hml_urls') or {}
+                elif kind == 'capture':
+                    state['captures'][(record['index'], record.get('capture_profile'))] = record
+                elif kind == 'result':
+                    result = record['result']
+                    state['results'][(result['index'], result.get('capture_profile'))] = result
+        return state
+
+    def append(self, kind, **data):
+        record = {'type': kind, 'time': datetime.now().isoformat(timespec='seconds'), **data}
+        line = json.dumps(record, ensure_ascii=False, default=str) + '\n'
+        with self._lock:
+            # Modo append: cada linha é uma única escrita, mesmo com vários workers gravando
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+
+class ReportWriter:
+    """Relatório HTML gravado incrementalmente, página a página, junto com o results.json
+    
+    O cabeçalho e o script de paginação/ordenação são gravados no início; cada resultado é
+    anexado assim que fica pronto, então um relatório parcial continua legível se a execução
+    cair no meio. finish() acrescenta o resumo e fecha o documento.
+    """
+
+    PAGE_SIZE = 50
+
+    SCRIPT = """
+        document.addEventListener('DOMContentLoaded', () => {
+            const container = document.getElementById('results');
+            const summary = document.getElementById('summary');
+            if (summary) document.querySelector('.header').after(summary);
+            const allEntries = [...container.querySelectorAll('.result')];
+            let entries = allEntries;
+            const sortSelect = document.getElementById('sort');
+            const profileSelect = document.getElementById('profile');
+            const pageLabel = document.getElementById('page-label');
+            const pageSize = %(page_size)d;
+            let page = 0;
+            const sorters = {
+                'diff-desc': (a, b) => b.dataset.diff - a.dataset.diff,
+                'diff-asc': (a, b) => a.dataset.diff - b.dataset.diff,
+                'index': (a, b) => a.dataset.index - b.dataset.index,
+            };
+            const pages = () => Math.max(1, Math.ceil(entries.length / pageSize));
+            const render = () => {
+                // Filtro por perfil de captura (navegador x viewport), quando há mais de um
+                const profile = profileSelect ? profileSelect.value : '';
+                allEntries.forEach(entry => { entry.style.display = 'none'; });
+                entries = allEntries.filter(entry => !profile || entry.dataset.profile === profile);
+                entries.sort(sorters[sortSelect.value]);
+                entries.forEach((entry, i) => {
+                    container.appendChild(entry);
+                    // Entradas ocultas não carregam as imagens (loading="lazy")
+                    entry.style.display = Math.floor(i / pageSize) === page ? '' : 'none';
+                });
+                pageLabel.textContent = `Página ${page + 1} de ${pages()} (${entries.length} resultados)`;
+            };
+            sortSelect.addEventListener('change', () => { page = 0; render(); });
+            if (profileSelect) profileSelect.addEventListener('change', () => { page = 0; render(); });
+            document.getElementById('prev').addEventListener('click', () => { page = Math.max(0, page - 1); render(); });
+            document.getElementById('next').addEventListener('click', () => { page = Math.min(pages() - 1, page + 1); render(); });
+            render();
+        });
+    """
+
+    def __init__(self, results_dir, prod_domain, hml_domain, json_interval=2.0):
+        self.results_dir = results_dir
+        self.prod_domain = prod_domain
+        self.hml_domain = hml_domain
+        self.report_path = os.path.join(results_dir, 'relatorio.html')
+        self.json_path = os.path.join(results_dir, 'results.json')
+        self.json_interval = json_interval
+        self.results = []
+        self._last_json_write = 0.0
+        self._file = None
+
+    def start(self, total_pages, profiles=None):
+        """Grava o cabeçalho; profiles (chaves 'navegador-viewport') habilita o filtro por perfil"""
+        profile_filter = ''
+        if profiles and len(profiles) > 1:
+            options = ''.join(f'<option value="{escape(key)}">{escape(key)}</option>' for key in profiles)
+            profile_filter = (f'<label>Perfil <select id="profile"><option value="">todos</option>'
+                              f'{options}</select></label>')
+        self._file = open(self.report_path, 'w', encoding='utf-8')
+        self._file.write(f"""<!DOCTYPE html>
+        <html>
+        <head>
+            <meta charset="utf-8">
+            <title>Relatório de Comparação Visual</title>
+            <style>
+                body {{ font-family: Arial, sans-serif; margin: 20px; }}
+                .header {{ background: #f0f0f0; padding: 15px; border-radius: 5px; }}
+                .controls {{ display: flex; gap: 10px; align-items: center; margin: 15px 0; }}
+                .result {{ margin: 15px 0; padding: 15px; border: 1px solid #ddd; border-radius: 5px; }}
+                .success {{ border-left: 5px solid #4CAF50; }}
+                .error {{ border-left: 5px solid #f44336; }}
+                .high-diff {{ border-left: 5px solid #ff9800; }}
+                .thumbnail {{ max-width: 480px; margin: 10px 0; border: 1px solid #ddd; }}
+                .stats {{ display: flex; flex-wrap: wrap; gap: 20px; margin: 10px 0; }}
+                .stat {{ background: #e3f2fd; padding: 10px; border-radius: 3px; }}
+                .regions {{ display: flex; flex-wrap: wrap; gap: 10px; }}
+                .region {{ margin: 0; }}
+                .region img {{ max-width: 600px; border: 1px solid #ddd; }}
+                .region figcaption {{ font-size: 12px; color: #555; }}
+                .waterfall {{ font-size: 11px; margin: 10px 0; max-width: 900px; }}
+                .waterfall summary {{ cursor: pointer; font-size: 14px; }}
+                .span {{ display: flex; align-items: center; height: 16px; }}
+                .span-label {{ width: 260px; flex-shrink: 0; color: #555; }}
+                .span-track {{ position: relative; flex-grow: 1; height: 10px; background: #f5f5f5; }}
+                .span-bar {{ position: absolute; height: 10px; min-width: 1px; }}
+                .env-prod {{ background: #4CAF50; }}
+                .env-hml {{ background: #ff9800; }}
+                .env-diff {{ background: #2196F3; }}
+                .stages {{ border-collapse: collapse; font-size: 13px; margin: 10px 0; }}
+                .stages td, .stages th {{ border: 1px solid #ddd; padding: 3px 8px; text-align: right; }}
+                .stages td:first-child {{ text-align: left; }}
+            </style>
+            <script>{self.SCRIPT % {'page_size': self.PAGE_SIZE}}</script>
+        </head>
+        <body>
+            <div class="header">
+                <h1>Comparação Visual: {escape(self.prod_domain)} vs {escape(self.hml_domain)}</h1>
+                <p><strong>Data:</strong> {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}</p>
+                <p><strong>Total de páginas:</strong> {total_pages}</p>
+                {f"<p><strong>Perfis:</strong> {escape(', '.join(profiles))}</p>" if profiles else ''}
+            </div>
+            <div class="controls">
+                <label>Ordenar por
+                    <select id="sort">
+                        <option value="diff-desc">maior diferença</option>
+                        <option value="diff-asc">menor diferença</option>
+                        <option value="index">ordem de descoberta</option>
+                    </select>
+                </label>
+                {profile_filter}
+                <button id="prev">◀</button>
+                <span id="page-label"></span>
+                <button id="next">▶</button>
+            </div>
+            <div id="results">
+        """)
+        self._file.flush()
+
+    def add(self, result):
+        """Anexa um resultado ao relatório e (no máximo a cada json_interval s) ao results.json"""
+        self.results.append(result)
+        self._file.write(self.entry_html(result))
+        self._file.flush()
+        if time.monotonic() - self._last_json_write >= self.json_interval:
+            self.write_json()
+
+    def write_json(self, stats=None):
+        payload = {
+            'prod_domain': self.prod_domain,
+            'hml_domain': self.hml_domain,
+            'generated_at': datetime.now().isoformat(timespec='seconds'),
+            'complete': stats is not None,
+            'stats': stats or {},
+            'results': sorted(self.results, key=lambda r: r.get('index', 0)),
+        }
+        tmp_path = f"{self.json_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(payload, f, ensure_ascii=False, indent=2, default=str)
+        os.replace(tmp_path, self.json_path)
+        self._last_json_write = time.monotonic()
+
+    def finish(self, stats):
+        self._file.write("""
+            </div>
+        """)
+        self._file.write(self.summary_html(self.results, stats))
+        self._file.write("""
+        </body>
+        </html>
+        """)
+        self._file.close()
+        self.write_json(stats)
+
+    @staticmethod
+    def summary_html(results, stats):
+        """Estatísticas gerais da execução"""
+        run = stats.get('run', {})
+        assets = stats.get('assets', {})
+        successful = [r for r in results if r['success']]
+        failed = [r for r in results if not r['success']]
+        high_diff = [r for r in successful if r['diff_percentage'] and r['diff_percentage'] > 10]
+        cache_counts = {status: sum(1 for r in successful if r.get('cache') == status)
+                        for status in ('fingerprint', 'identical', 'phash', 'hit', 'miss')}
+        baselines_reused = sum(1 for r in results if r.get('prod_source') == 'baseline')
+        
+        # Sucessos e grandes diferenças por perfil de captura, quando há matriz
+        profiles_html = ''
+        profiles = sorted({r['capture_profile'] for r in results if r.get('capture_profile')})
+        for profile in profiles:
+            of_profile = [r for r in successful if r.get('capture_profile') == profile]
+            profile_high = sum(1 for r in of_profile if r['diff_percentage'] > 10)
+            profiles_html += f"""
+                <div class="stat">
+                    <strong>{escape(profile)}:</strong> {len(of_profile)} sucessos, {profile_high} com diferença >10%
+                </div>"""
+        
+        shards_note = f", somados em {run['shards']} shards" if run.get('shards') else ''
+        
+        return f"""
+            <div class="stats" id="summary">
+                <div class="stat">
+                    <strong>Sucessos:</strong> {len(successful)}
+                </div>
+                <div class="stat">
+                    <strong>Falhas:</strong> {len(failed)}
+                </div>
+                <div class="stat">
+                    <strong>Grandes diferenças (>10%):</strong> {len(high_diff)}
+                </div>
+                <div class="stat">
+                    <strong>Páginas/minuto:</strong> {run.get('pages_per_minute', 0):.1f}
+                    ({run.get('workers', '?')} workers de captura,
+                    {run.get('diff_workers', '?')} de diff{shards_note})
+                </div>
+                <div class="stat">
+                    <strong>Cache de diff:</strong> {cache_counts['hit']} hits, {cache_counts['miss']} misses,
+                    {cache_counts['identical']} idênticas, {cache_counts['phash']} quase idênticas (dHash)
+                </div>
+                <div class="stat">
+                    <strong>Caminho rápido (DOM/CSS idênticos, sem screenshot):</strong> {cache_counts['fingerprint']}
+                </div>
+                <div class="stat">
+                    <strong>Baselines de produção reaproveitados:</strong> {baselines_reused}
+                </div>
+                <div class="stat">
+                    <strong>Assets:</strong> {assets.get('hits', 0)} do cache, {assets.get('revalidated', 0)} revalidados,
+                    {assets.get('misses', 0)} baixados, {assets.get('blocked', 0)} bloqueados
+                    ({assets.get('bytes_saved', 0) / 1024 ** 2:.1f} MB economizados)
+                </div>
+                {profiles_html}
+                {ReportWriter.hosts_html(stats.get('hosts'))}
+                {ReportWriter.stages_html(stats.get('stages'))}
+            </div>
+        """
+
+    @staticmethod
+    def hosts_html(hosts):
+        """Taxa efetiva e limites a que o controle adaptativo chegou em cada host"""
+        if not hosts:
+            return ''
+        rows = ''.join(
+            f"<tr><td>{escape(host)}</td><td>{stats['requests']}</td><td>{stats['effective_rate']:.2f}</td>"
+            f"<td>{stats['rate']:.1f} (pico {stats['peak_rate']:.1f})</td>"
+            f"<td>{stats['limit']} (pico {stats['peak_limit']})</td><td>{stats['latency_ms']:.0f}</td>"
+            f"<td>{stats['errors']}</td><td>{stats['throttled']}</td><td>{stats['decreases']}</td></tr>"
+            for host, stats in sorted(hosts.items())
+        )
+        return f"""
+                <table class="stages">
+                    <tr><th>Host</th><th>Requisições</th><th>Taxa efetiva (req/s)</th><th>Taxa final</th>
+                    <th>Simultâneas</th><th>Latência (ms)</th><th>Erros</th><th>429/5xx</th><th>Reduções</th></tr>
+                    {rows}
+                </table>
+        """
+
+    @staticmethod
+    def stages_html(stages):
+        """Tabela com p50/p95/máximo de cada etapa (mesmos dados de timings.json)"""
+        if not stages:
+            return ''
+        rows = ''.join(
+            f"<tr><td>{escape(stage)}</td><td>{stats['count']}</td><td>{stats['p50']:.0f}</td>"
+            f"<td>{stats['p95']:.0f}</td><td>{stats['max']:.0f}</td><td>{stats['total'] / 1000:.1f}</td></tr>"
+            for stage, stats in sorted(stages.items(), key=lambda item: item[1]['total'], reverse=True)
+        )
+        return f"""
+                <table class="stages">
+                    <tr><th>Etapa</th><th>Spans</th><th>p50 (ms)</th><th>p95 (ms)</th><th>Máx (ms)</th><th>Total (s)</th></tr>
+                    {rows}
+                </table>
+        """
+
+    @staticmethod
+    def waterfall_html(spans):
+        """Cascata das etapas de uma página: captura prod/hml em paralelo e depois o diff"""
+        if not spans:
+            return ''
+        t0 = min(span['start'] for span in spans)
+        total = max(span['start'] + span['duration_ms'] / 1000 for span in spans) - t0
+        if total <= 0:
+            return ''
+        rows = ''.join(
+            f'<div class="span"><span class="span-label">{escape(span["env"] or "")} {escape(span["stage"])} '
+            f'({span["duration_ms"]:.0f} ms)</span><span class="span-track">'
+            f'<span class="span-bar env-{escape(span["env"] or "diff")}" '
+            f'style="left: {(span["start"] - t0) / total * 100:.2f}%; '
+            f'width: {span["duration_ms"] / 1000 / total * 100:.2f}%"></span></span></div>'
+            for span in spans
+        )
+        return (f'<details class="waterfall"><summary>Tempo por etapa ({total:.1f} s)</summary>'
+                f'{rows}</details>')
+
+    @staticmethod
+    def readiness_html(readiness):
+        """Resumo do tempo gasto em cada fase de espera da página, por ambiente"""
+        if not readiness:
+            return ''
+        labels = (('network_idle', 'rede'), ('scroll', 'scroll'), ('images', 'imagens'),
+                  ('fonts', 'fontes'), ('layout', 'layout'))
+        parts = []
+        for env, env_label in (('prod', 'PROD'), ('hml', 'HML')):
+            timings = readiness.get(env)
+            if not timings:
+                continue
+            phases = ', '.join(f"{label} {timings[key]}" for key, label in labels if key in timings)
+            state = 'estável' if timings.get('layout_state') == 'stable' else 'limite atingido'
+            parts.append(f"{env_label} {timings['total']} ms ({phases}; layout {state})")
+        if not parts:
+            return ''
+        return f"<p><strong>Espera até estabilizar:</strong> {' | '.join(parts)}</p>"
+
+    def entry_html(self, result):
+        """HTML de um resultado; a ordenação usa data-diff e data-index"""
+        prod_url, hml_url = escape(result['prod_url']), escape(result['hml_url'])
+        index = result.get('index', 0)
+        profile = escape(result.get('capture_profile') or '')
+        profile_label = f' <small>[{profile}]</small>' if profile else ''
+        if not result['success']:
+            # Falhas ficam no topo da ordenação por maior diferença
+            return f"""
+                <div class="result error" data-diff="1000" data-index="{index}" data-profile="{profile}">
+                    <h3>{escape(result['page'])}{profile_label} - ERRO</h3>
+                    <p><strong>Produção:</strong> {prod_url}</p>
+                    <p><strong>Homologação:</strong> {hml_url}</p>
+                    <p>Falha ao capturar screenshots</p>
+                </div>
+            """
+        
+        diff = result['diff_percentage']
+        css_class = 'high-diff' if diff and diff > 10 else 'success'
+        # Páginas muito altas geram vários tiles; todos ficam a um clique
+        full_links = ' '.join(
+            f'<a href="comparisons/{image}" target="_blank">{image}</a>' for image in result['images']
+        )
+        if result.get('cache') == 'fingerprint':
+            images_html = ('<p>⚡ Caminho rápido: DOM, CSS, fontes e imagens idênticos nos dois ambientes — '
+                           'screenshots e diff não foram feitos.</p>')
+        elif result.get('cache') in ('identical', 'phash'):
+            images_html = '<p>Screenshots idênticos (ou quase, pelo dHash) — imagem de comparação não gerada.</p>'
+        else:
+            images_html = ''
+            if result.get('thumbnail'):
+                images_html += (f'<a href="comparisons/{result["images"][0]}" target="_blank">'
+                                f'<img src="comparisons/{result["thumbnail"]}" class="thumbnail" loading="lazy" '
+                                f'alt="{escape(result["page"])} miniatura"></a>')
+            if result.get('regions'):
+                images_html += '<div class="regions">' + ''.join(
+                    f'<figure class="region"><a href="comparisons/{region["image"]}" target="_blank">'
+                    f'<img src="comparisons/{region["image"]}" loading="lazy" alt="região {region["index"]}"></a>'
+                    f'<figcaption>#{region["index"]} · {region["width"]}×{region["height"]} px · '
+                    f'{region["share"] * 100:.0f}% da mudança</figcaption></figure>'
+                    for region in result['regions'] if region.get('image')
+                ) + '</div>'
+            images_html += f'<p><strong>Comparação completa:</strong> {full_links}'
+            if result.get('regions_file'):
+                images_html += f' · <a href="comparisons/{result["regions_file"]}" target="_blank">regiões (JSON)</a>'
+            if result.get('profile'):
+                images_html += f' · <a href="{result["profile"]}" target="_blank">perfil do diff</a>'
+            images_html += '</p>'
+        
+        return f"""
+                <div class="result {css_class}" data-diff="{diff:.4f}" data-index="{index}" data-profile="{profile}">
+                    <h3>{escape(result['page'])}{profile_label}</h3>
+                    <p><strong>Diferença:</strong> {diff:.1f}%</p>
+                    <p><strong>Produção:</strong> <a href="{prod_url}" target="_blank">{prod_url}</a></p>
+                    <p><strong>Homologação:</strong> <a href="{hml_url}" target="_blank">{hml_url}</a></p>
+                    {self.readiness_html(result.get('readiness'))}
+                    {images_html}
+                    {self.waterfall_html(result.get('timings'))}
+                </div>
+            """
+
 
 class BulkVisualComparator:
-    def __init__(self, prod_domain, hml_domain, max_pages=20):
-        self.prod_domain = prod_domain.replace('https://', '').replace('http://', '')
-        self.hml_domain = hml_domain.replace('https://', '').replace('http://', '')
+    def __init__(self, prod_domain, hml_domain, max_pages=20, workers=4, max_rate=None,
+                 diff_workers=None, diff_queue_size=None, diff_mode='auto', strip_height=TILE_HEIGHT,
+                 save_screenshots=True, screenshot_format='png', screenshot_compression=None,
+                 cache_dir=DEFAULT_CACHE_DIR, phash_threshold=None, use_baselines=True,
+                 baseline_max_age_days=7, baseline_max_bytes=2 * 1024 ** 3, diff_cache_max_age_days=7,
+                 diff_cache_max_bytes=2 * 1024 ** 3, readiness=None,
+                 asset_cache_max_bytes=1024 ** 3, blocked_domains=DEFAULT_BLOCKED_DOMAINS,
+                 resume_dir=None, profile_diff=None, urls=None, viewports=('desktop',),
+                 browsers=('chromium',), shard=None, results_dir=None, fingerprint=None):
+        # Um esquema explícito no domínio dispensa a detecção de protocolo
+        self.prod_protocol = urlparse(prod_domain).scheme if prod_domain.startswith(('http://', 'https://')) else None
+        self.hml_protocol = urlparse(hml_domain).scheme if hml_domain.startswith(('http://', 'https://')) else None
+        self.prod_domain = prod_domain.replace('https://', '').replace('http://', '').rstrip('/')
+        self.hml_domain = hml_domain.replace('https://', '').replace('http://', '').rstrip('/')
         self.max_pages = max_pages
-        self.found_urls = set()
-        self.results_dir = f"comparison_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        self.workers = max(1, workers)
+        # O diff é CPU-bound: por padrão um processo por núcleo
+        self.diff_workers = max(1, diff_workers or os.cpu_count() or 1)
+        self.diff_queue_size = diff_queue_size or self.workers * 2
+        # 'full' = imagem única, 'tiled' = faixas com memória limitada, 'auto' = tiled em páginas altas
+        self.diff_mode = diff_mode
+        self.strip_height = strip_height
+        # Screenshots brutos: formato 'png' ou 'webp' (sem perdas) e nível de compressão PNG (0-9)
+        self.save_screenshots = save_screenshots
+        self.screenshot_format = screenshot_format
+        self.screenshot_compression = screenshot_compression
+        self.screenshot_writer = None
+        self.report_writer = None
+        # Cache de diffs por conteúdo (None desativa) e limite do dHash para pular o diff completo
+        # (None desativa; distâncias até o limite são tratadas como praticamente idênticas)
+        self.cache_dir = cache_dir
+        self.diff_cache_max_age_days = diff_cache_max_age_days
+        self.diff_cache_max_bytes = diff_cache_max_bytes
+        self.phash_threshold = phash_threshold
         
-        # Detecta protocolos de cada domínio independentemente
-        self.prod_protocol = self.detect_protocol(self.prod_domain)
-        self.hml_protocol = self.detect_protocol(self.hml_domain)
+        # Matriz de captura (navegador x viewport); o perfil também identifica os baselines da produção
+        self.viewports = list(viewports)
+        self.browsers = list(browsers)
+        self.profiles = build_profiles(self.viewports, self.browsers)
+        self.readiness = readiness or PageReadiness()
+        # Caminho rápido opcional: True usa as máscaras padrão, um dict configura o DomFingerprint
+        if fingerprint is True:
+            fingerprint = DomFingerprint()
+        elif isinstance(fingerprint, dict):
+            fingerprint = DomFingerprint(**fingerprint)
+        self.fingerprint = fingerprint or None
+        self.connectivity = HostConnectivity()
+        self.session = self.connectivity.session
+        # Taxa e concorrência por host se ajustam sozinhas; max_rate (req/s) é só um teto opcional
+        self.rate_limiter = HostRateLimiter(max_concurrency=self.workers, max_rate=max_rate)
         
-        print(f"🔗 Protocolo PRODUÇÃO: {self.prod_protocol.upper()}")
-        print(f"🔗 Protocolo HOMOLOGAÇÃO: {self.hml_protocol.upper()}")
+        # Interceptação de requisições: cache de assets estáticos e bloqueio de terceiros
+        asset_cache = AssetCache(os.path.join(cache_dir, 'assets'), max_bytes=asset_cache_max_bytes) \
+            if cache_dir else None
+        self.interceptor = RequestInterceptor(asset_cache, blocked_domains)
+        
+        # Baselines persistentes da produção (desativados sem diretório de cache)
+        self.baseline_store = None
+        if use_baselines and cache_dir:
+            self.baseline_store = BaselineStore(os.path.join(cache_dir, 'baselines'),
+                                                max_age_days=baseline_max_age_days,
+                                                max_bytes=baseline_max_bytes)
+        self.found_urls = set()
+        self.run_stats = {}
+        # Instrumentação por etapa; profile_diff = 'cprofile' ou 'tracemalloc' perfila cada diff
+        self.timer = StageTimer()
+        self.profile_diff = profile_diff
+        # Retomada: reaproveita o diretório e o diário de uma execução interrompida
+        # Shard (i, N): só as páginas cujo hash cai no shard i são capturadas nesta execução
+        self.shard = tuple(shard) if shard else None
+        default_dir = f"comparison_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        if self.shard:
+            default_dir += f"_shard{self.shard[0]}of{self.shard[1]}"
+        self.results_dir = resume_dir or results_dir or default_dir
+        self.resume_state = RunJournal.load(self.results_dir) if resume_dir else None
+        self.journal = RunJournal(self.results_dir)
+        # Lista pré-definida de páginas: pula o crawling (entradas de load_url_list)
+        self.urls = urls
+        self.hml_urls = {}
         
         # Cria diretório para resultados
         os.makedirs(self.results_dir, exist_ok=True)
@@ -31,415 +2485,1184 @@ class BulkVisualComparator:
         os.makedirs(f"{self.results_dir}/comparisons", exist_ok=True)
         
     def detect_protocol(self, domain):
-        """Detecta se o domínio usa HTTP ou HTTPS"""
-        # Primeiro tenta HTTPS
-        try:
-            response = requests.get(f"https://{domain}", timeout=10, verify=False)
-            if response.status_code == 200:
-                return "https"
-        except:
-            pass
+        """Detecta se o domínio usa HTTP ou HTTPS (resultado cacheado por host)"""
+        return self.connectivity.detect_protocol(domain)
+
+    def in_shard(self, url):
+        return self.shard is None or shard_of(url, self.shard[1]) == self.shard[0] - 1
+
+    async def resolve_protocols(self):
+        """Detecta os protocolos que ainda não são conhecidos, os dois hosts em paralelo"""
+        async def resolve(env, domain):
+            with self.timer.span('detect_protocol', env=env):
+                return await asyncio.to_thread(self.detect_protocol, domain)
+        
+        targets = (('prod', self.prod_domain, self.prod_protocol), ('hml', self.hml_domain, self.hml_protocol))
+        # Esquema explícito: a conectividade precisa saber, senão a captura volta a tentar os dois
+        for env, domain, protocol in targets:
+            if protocol is not None:
+                self.connectivity.set_scheme(domain, protocol)
+        pending = {env: domain for env, domain, protocol in targets if protocol is None}
+        detected = dict(zip(pending, await asyncio.gather(*(resolve(env, domain) for env, domain in pending.items()))))
+        self.prod_protocol = detected.get('prod', self.prod_protocol)
+        self.hml_protocol = detected.get('hml', self.hml_protocol)
+        
+        print(f"🔗 Protocolo PRODUÇÃO: {self.prod_protocol.upper()}")
+        print(f"🔗 Protocolo HOMOLOGAÇÃO: {self.hml_protocol.upper()}")
+
+    def expand_targets(self, entries):
+        """Converte as entradas da lista de URLs em URLs de produção + mapa para homologação
         
-        # Se HTTPS falhar, tenta HTTP
-        try:
-            response = requests.get(f"http://{domain}", timeout=10)
-            if response.status_code == 200:
-                return "http"
-        except:
-            pass
+        Caminhos relativos ('/produtos') ganham o protocolo e o domínio de cada ambiente.
+        """
+        def absolute(target, protocol, domain):
+            if target.startswith(('http://', 'https://')):
+                return target
+            return f"{protocol}://{domain}/{target.lstrip('/')}"
         
-        # Se ambos falharem, assume HTTPS como padrão
-        return "https"
+        pages, hml_urls, seen = [], {}, set()
+        for prod_target, hml_target in entries:
+            prod_url = absolute(prod_target, self.prod_protocol, self.prod_domain)
+            if prod_url in seen:
+                continue
+            seen.add(prod_url)
+            pages.append(prod_url)
+            if hml_target:
+                hml_urls[prod_url] = absolute(hml_target, self.hml_protocol, self.hml_domain)
+        return pages, hml_urls
         
     # (Dentro da classe BulkVisualComparator)
 
-    def discover_pages(self, browser): # <<-- RECEBE O NAVEGADOR
-        """Descobre páginas do site automaticamente usando Playwright para lidar com JS."""
+    async def discover_pages(self, browser): # <<-- RECEBE O NAVEGADOR
+        """Descobre páginas do site via sitemap e, se preciso, renderizando links com Playwright."""
         print(f"🔍 Descobrindo páginas em {self.prod_domain}...")
 
-        base_url = f"{self.prod_protocol}://{self.prod_domain}"
-        pages_to_visit = [base_url]
-        visited = set()
-
-        # O bloco "with sync_playwright()" FOI REMOVIDO DAQUI
-        context = browser.new_context(ignore_https_errors=True)
-        page = context.new_page()
-
-        while len(self.found_urls) < self.max_pages and pages_to_visit:
-            current_url = pages_to_visit.pop(0)
-
-            if current_url in visited:
-                continue
-
-            visited.add(current_url)
-            # Remove a hashtag e tudo que vem depois para evitar duplicatas (ex: /pagina#main)
-            clean_url = current_url.split('#')[0]
-
-            try:
-                # Verifica se a URL limpa (sem a âncora) já foi adicionada
-                if clean_url in self.found_urls:
-                    continue
-                
-                print(f"  Analisando: {current_url}")
-                page.goto(current_url, wait_until='networkidle', timeout=30000)
-                self.found_urls.add(clean_url)
-
-                links = page.eval_on_selector_all('a[href]', 'elements => elements.map(el => el.href)')
-
-                for link in links:
-                    full_url = urljoin(current_url, link)
-                    parsed = urlparse(full_url)
-                    
-                    # Normaliza a URL para evitar duplicatas como http://site.com e http://site.com/
-                    normalized_url = full_url.split('#')[0].rstrip('/')
-
-                    if (parsed.netloc.endswith(self.prod_domain) and
-                        normalized_url not in visited and
-                        normalized_url not in pages_to_visit and
-                        not any(ext in full_url.lower() for ext in ['.pdf', '.jpg', '.png', '.gif', '.css', '.js'])):
-                        
-                        pages_to_visit.append(normalized_url)
-                        
-                        if len(self.found_urls) >= self.max_pages:
-                            break
-
-            except Exception as e:
-                print(f"  ❌ Erro ao acessar {current_url}: {e}")
-                continue
+        crawler = SiteCrawler(self.prod_domain, self.prod_protocol, self.max_pages,
+                              concurrency=self.workers, connectivity=self.connectivity,
+                              interceptor=self.interceptor, timer=self.timer,
+                              rate_limiter=self.rate_limiter)
+        with self.timer.span('discover', env='prod'):
+            pages = await crawler.crawl(browser)
+        self.found_urls = set(pages)
         
-        page.close()
-        context.close()
-        # O "browser.close()" FOI REMOVIDO DAQUI
-        print(f"✅ Encontradas {len(self.found_urls)} páginas para comparar")
-        return list(self.found_urls)
+        print(f"✅ Encontradas {len(pages)} páginas para comparar")
+        return pages
     
     # (Dentro da classe BulkVisualComparator)
 
-    def capture_screenshot(self, browser, url, filename):
-        """Captura screenshot de uma página com fallback HTTP/HTTPS"""
+    async def capture_screenshot(self, pool, url, page_name=None, env=None, fingerprints=None):
+        """Captura screenshot de uma página com fallback HTTP/HTTPS
+        
+        Devolve um dict com os bytes PNG ('image'), a URL que funcionou e os validadores HTTP
+        do documento (ETag, Last-Modified e hash do HTML), ou None se todas as tentativas falharem.
+        page_name e env só marcam os spans de tempo de cada etapa.
+        
+        Com 'fingerprints' (futures por ambiente, criadas em capture_page) a impressão digital da
+        página é publicada e comparada com a do outro ambiente antes do screenshot; se forem iguais,
+        devolve 'image' None e 'source' 'fingerprint' sem tirar o screenshot.
+        """
+        timer = self.timer
         original_url = url
         
         # Se a URL não tem protocolo, detecta automaticamente
         if not url.startswith(('http://', 'https://')):
             domain = url
-            protocol = self.detect_protocol(domain)
+            with timer.span('capture.detect_protocol', page_name, env):
+                protocol = await asyncio.to_thread(self.detect_protocol, domain)
             url = f"{protocol}://{domain}"
         
         # Lista de URLs para tentar (protocolo original e fallback)
         urls_to_try = [url]
         
-        # Adiciona fallback se não funcionou
-        if url.startswith('https://'):
-            urls_to_try.append(url.replace('https://', 'http://'))
-        elif url.startswith('http://'):
-            urls_to_try.append(url.replace('http://', 'https://'))
+        # Adiciona fallback só se o protocolo que funciona no host ainda não é conhecido
+        host = urlparse(url).netloc
+        if not self.connectivity.known_scheme(host):
+            if url.startswith('https://'):
+                urls_to_try.append(url.replace('https://', 'http://'))
+            elif url.startswith('http://'):
+                urls_to_try.append(url.replace('http://', 'https://'))
         
         for attempt_url in urls_to_try:
-            context = None  # Inicializa o contexto como None
+            # Host com circuito aberto falha na hora, sem gastar o timeout do goto
+            allowed = self.connectivity.allow(host)
+            if not allowed:
+                print(f"    ⏭️  Host {host} indisponível (circuit breaker aberto): {attempt_url}")
+                break
+            
             page = None     # Inicializa a page como None
+            reached_host = False
             try:
                 print(f"    🔗 Tentando: {attempt_url}")
                 
-                # Não usa mais 'with sync_playwright()'. Usa o 'browser' recebido.
-                context = browser.new_context(
-                    ignore_https_errors=True,
-                    viewport={'width': 1200, 'height': 800}
-                )
-                
-                page = context.new_page()
-                
-                page.goto(attempt_url, wait_until='networkidle', timeout=30000)
-                page.wait_for_timeout(2000)
-                
-                # Scroll automático
-                page.evaluate("""
-                    () => {
-                        return new Promise((resolve) => {
-                            let totalHeight = 0;
-                            let distance = 100;
-                            let timer = setInterval(() => {
-                                let scrollHeight = document.body.scrollHeight;
-                                window.scrollBy(0, distance);
-                                totalHeight += distance;
-
-                                if(totalHeight >= scrollHeight){
-                                    clearInterval(timer);
-                                    resolve();
-                                }
-                            }, 50);
-                        });
-                    }
-                """)
-                
-                page.evaluate("window.scrollTo(0, 0)")
-                page.wait_for_timeout(1000)
-                
-                page.screenshot(path=filename, full_page=True)
-                
-                # Fecha apenas a página e o contexto
-                page.close()
-                context.close()
+                # Reaproveita um contexto do pool em vez de criar um novo a cada tentativa
+                async with pool.acquire() as context:
+                    page = await context.new_page()
+                    try:
+                        assets = self.fingerprint.watch(page) if fingerprints is not None else None
+                        try:
+                            with timer.span('capture.goto', page_name, env):
+                                response = await self.rate_limiter.goto(page, attempt_url, wait_until='load',
+                                                                        timeout=30000)
+                        except Exception as e:
+                            reached_host = True
+                            self.connectivity.record_failure(host, e)
+                            raise
+                        reached_host = True
+                        self.connectivity.record_success(host)
+                        if not self.connectivity.known_scheme(host):
+                            self.connectivity.set_scheme(host, urlparse(attempt_url).scheme)
+                        validators = await document_validators(response)
+                        
+                        # Espera só o necessário: rede, lazy loading, imagens, fontes e layout estável
+                        readiness_start = time.time()
+                        readiness = await self.readiness.wait(page)
+                        self.record_readiness(readiness, readiness_start, page_name, env)
+                        
+                        if fingerprints is not None and not fingerprints[env].done():
+                            with timer.span('capture.fingerprint', page_name, env):
+                                fingerprint = await self.fingerprint.compute(page, assets)
+                            if await self.fingerprint.matches(fingerprints, env, fingerprint):
+                                print(f"    ⚡ DOM e CSS idênticos aos do outro ambiente, screenshot pulado: {attempt_url}")
+                                return {'image': None, 'url': attempt_url, 'source': 'fingerprint',
+                                        'readiness': readiness, **validators}
+                        
+                        # Fica em memória: o diff decodifica direto do buffer, sem reler do disco
+                        with timer.span('capture.screenshot', page_name, env):
+                            screenshot = await page.screenshot(full_page=True)
+                    finally:
+                        # Fecha apenas a página; o contexto volta para o pool sem o storage dela
+                        if not page.is_closed():
+                            await ContextPool.clear_storage(page)
+                            await page.close()
                 
                 print(f"    ✅ Screenshot capturado com sucesso: {attempt_url}")
-                return True
+                return {'image': screenshot, 'url': attempt_url, 'source': 'captured',
+                        'readiness': readiness, **validators}
                 
             except Exception as e:
                 print(f"    ⚠️  Erro com {attempt_url}: {e}")
-                # Garante que os recursos sejam fechados em caso de erro
-                if page and not page.is_closed():
-                    page.close()
-                if context:
-                    context.close()
                 continue
+            finally:
+                if not reached_host:
+                    self.connectivity.release_probe(host, allowed)
         
         print(f"    ❌ Falha em todas as tentativas para {original_url}")
-        return False
+        return None
     
-    def create_side_by_side_comparison(self, prod_img_path, hml_img_path, output_path, page_name):
-        """Cria comparação lado a lado"""
+    async def capture_production(self, pool, url, page_name=None, profile=None, fingerprints=None):
+        """Captura a produção, reaproveitando o baseline salvo se os validadores HTTP não mudaram"""
+        store = self.baseline_store
+        profile = profile or self.profiles[0]
+        if store:
+            with self.timer.span('capture.baseline_check', page_name, 'prod'):
+                entry = await asyncio.to_thread(store.get, url, profile['viewport_key'], profile['browser'])
+                fresh = entry and await self.check_baseline(url, entry)
+            if fresh:
+                with self.timer.span('capture.baseline_load', page_name, 'prod'):
+                    image = await asyncio.to_thread(store.load, entry)
+                if image is not None:
+                    print(f"    ♻️  Baseline de produção reaproveitado: {url}")
+                    return {'image': image, 'url': url, 'source': 'baseline'}
+        
+        capture = await self.capture_screenshot(pool, url, page_name, 'prod', fingerprints)
+        if capture and capture['image'] is not None and store:
+            with self.timer.span('capture.baseline_store', page_name, 'prod'):
+                await asyncio.to_thread(store.put, url, profile['viewport_key'], profile['browser'], capture)
+        return capture
+
+    def record_readiness(self, readiness, start, page_name, env):
+        """Converte os tempos de cada fase do PageReadiness em spans consecutivos"""
+        for phase in ('network_idle', 'scroll', 'images', 'fonts', 'layout'):
+            if phase in readiness:
+                self.timer.record(f"capture.readiness.{phase}", readiness[phase], page_name, env, start)
+                start += readiness[phase] / 1000
+
+    async def check_baseline(self, url, entry):
+        """Revalida o baseline passando pelo circuit breaker e pela vaga do host
+        
+        Com o circuito aberto não há GET condicional (nem os 10 s de timeout): o baseline
+        não é reaproveitado e a captura falha na hora.
+        """
+        host = urlparse(url).netloc
+        allowed = self.connectivity.allow(host)
+        if not allowed:
+            return False
+        try:
+            async with self.rate_limiter.slot(host) as request:
+                return await asyncio.to_thread(self.baseline_is_fresh, url, entry, request)
+        finally:
+            self.connectivity.release_probe(host, allowed)
+
+    def baseline_is_fresh(self, url, entry, request=None):
+        """Revalida o baseline com um GET condicional (ETag/Last-Modified ou hash do HTML)
+        
+        'request' (a vaga do HostRateLimiter) recebe o código HTTP da resposta.
+        """
+        host = urlparse(url).netloc
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            response = self.session.get(url, headers=headers, timeout=10, verify=False)
+        except requests.RequestException as e:
+            self.connectivity.record_failure(host, e)
+            return False
+        self.connectivity.record_success(host)
+        if request is not None:
+            request['status'] = response.status_code
+        
+        if response.status_code == 304:
+            return True
+        if response.status_code != 200:
+            return False
+        # Alguns servidores ignoram requisições condicionais: compara os validadores manualmente
+        if entry['etag'] and response.headers.get('ETag') == entry['etag']:
+            return True
+        return bool(entry['dom_hash']) and content_hash(response.content) == entry['dom_hash']
+
+    @staticmethod
+    def create_side_by_side_comparison(prod_img, hml_img, output_path, page_name,
+                                       diff_mode='auto', strip_height=TILE_HEIGHT, timer=None):
+        """Cria comparação lado a lado; páginas muito altas usam o modo em faixas
+        
+        As imagens podem ser caminhos, bytes codificados (PNG/WebP) ou arrays já decodificados.
+        As linhas são alinhadas antes do diff, então uma faixa inserida não desloca o resto da página.
+        """
+        timer = timer or StageTimer()
         try:
-            # Carrega imagens
-            prod_img = cv2.imread(prod_img_path)
-            hml_img = cv2.imread(hml_img_path)
+            # Carrega imagens (arrays já decodificados passam direto)
+            prod_img = load_image(prod_img)
+            hml_img = load_image(hml_img)
             
             if prod_img is None or hml_img is None:
                 print(f"    ❌ Erro ao carregar imagens para {page_name}")
-                return False
+                return None
             
-            # Redimensiona para mesma altura
             max_height = max(prod_img.shape[0], hml_img.shape[0])
+            if diff_mode == 'tiled' or (diff_mode == 'auto' and max_height > TILED_DIFF_MIN_HEIGHT):
+                return BulkVisualComparator.create_tiled_comparison(
+                    prod_img, hml_img, output_path, page_name, strip_height, timer=timer
+                )
             
-            # Calcula proporções para manter aspect ratio
-            prod_ratio = prod_img.shape[1] / prod_img.shape[0]
-            hml_ratio = hml_img.shape[1] / hml_img.shape[0]
-            
-            prod_width = int(max_height * prod_ratio)
-            hml_width = int(max_height * hml_ratio)
-            
-            prod_resized = cv2.resize(prod_img, (prod_width, max_height))
-            hml_resized = cv2.resize(hml_img, (hml_width, max_height))
-            
-            # Calcula diferença para destacar mudanças
-            if prod_resized.shape == hml_resized.shape:
-                diff = cv2.absdiff(prod_resized, hml_resized)
-                gray_diff = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY)
-                _, thresh = cv2.threshold(gray_diff, 30, 255, cv2.THRESH_BINARY)
-                diff_pixels = np.sum(thresh > 0)
-                total_pixels = prod_resized.shape[0] * prod_resized.shape[1]
-                diff_percentage = (diff_pixels / total_pixels) * 100
-            else:
-                diff_percentage = 100  # Tamanhos diferentes = 100% diferente
-            
-            # Cria espaço entre as imagens
-            separator = np.ones((max_height, 20, 3), dtype=np.uint8) * 128
-            
-            # Junta as imagens lado a lado
-            comparison = np.hstack([prod_resized, separator, hml_resized])
-            
-            # Adiciona cabeçalho com informações
-            header_height = 80
-            header = np.ones((header_height, comparison.shape[1], 3), dtype=np.uint8) * 50
-            
-            # Adiciona texto no cabeçalho
-            font = cv2.FONT_HERSHEY_SIMPLEX
-            font_scale = 0.7
-            thickness = 2
-            
-            # Título da página
-            cv2.putText(header, f"PAGINA: {page_name}", (10, 25), font, font_scale, (255, 255, 255), thickness)
-            
-            # Labels das colunas
-            cv2.putText(header, "PRODUCAO", (10, 55), font, font_scale, (0, 255, 0), thickness)
-            hml_x = prod_width + 30
-            cv2.putText(header, "HOMOLOGACAO", (hml_x, 55), font, font_scale, (0, 100, 255), thickness)
+            # Mesma largura e linhas alinhadas (faixas inseridas viram lacunas do outro lado)
+            with timer.span('diff.align', page_name, 'diff'):
+                hml_img, prod_index, hml_index, states = prepare_alignment(prod_img, hml_img)
+                prod_aligned = aligned_strip(prod_img, prod_index)
+                hml_aligned = aligned_strip(hml_img, hml_index)
             
-            # Porcentagem de diferença
-            diff_color = (0, 0, 255) if diff_percentage > 5 else (0, 255, 0)
-            diff_x = comparison.shape[1] - 300
-            cv2.putText(header, f"DIFF: {diff_percentage:.1f}%", (diff_x, 40), font, font_scale, diff_color, thickness)
+            # Calcula a diferença só nas faixas que realmente mudaram
+            width = prod_img.shape[1]
+            total_pixels = len(states) * width
+            with timer.span('diff.mask', page_name, 'diff'):
+                mask = diff_mask(prod_aligned, hml_aligned, states)
+                diff_percentage = np.count_nonzero(mask) / total_pixels * 100 if total_pixels else 0.0
+            with timer.span('diff.regions', page_name, 'diff'):
+                regions = score_regions(find_regions(mask), prod_index, hml_index)
+            del mask
             
-            # Junta cabeçalho com comparação
-            final_image = np.vstack([header, comparison])
+            with timer.span('diff.compose', page_name, 'diff'):
+                # Junta as imagens lado a lado, com o separador marcando as faixas alteradas
+                comparison = np.hstack([prod_aligned, state_separator(states), hml_aligned])
+                draw_regions(comparison, regions, width)
+                
+                # Adiciona cabeçalho com informações
+                header = comparison_header(comparison.shape[1], prod_img.shape[1], page_name, diff_percentage)
+                
+                # Junta cabeçalho com comparação
+                final_image = np.vstack([header, comparison])
             
             # Salva resultado
-            cv2.imwrite(output_path, final_image)
-            return diff_percentage
+            with timer.span('diff.write', page_name, 'diff'):
+                cv2.imwrite(output_path, final_image)
+            base, ext = os.path.splitext(output_path)
+            with timer.span('diff.thumbnail', page_name, 'diff'):
+                thumbnail = save_thumbnail([downscale(final_image)], f"{base}_thumb.webp")
+            with timer.span('diff.region_crops', page_name, 'diff'):
+                region_images = save_region_crops(prod_img, hml_img, prod_index, hml_index, regions, base, ext)
+            return {'diff_percentage': float(diff_percentage), 'images': [os.path.basename(output_path)],
+                    'thumbnail': thumbnail, 'regions': regions, 'region_images': region_images}
             
         except Exception as e:
             print(f"    ❌ Erro ao criar comparação para {page_name}: {e}")
             return None
+
+    @staticmethod
+    def create_tiled_comparison(prod_img, hml_img, output_path, page_name, strip_height=TILE_HEIGHT, timer=None):
+        """Compara as imagens em faixas horizontais e grava a composição como um conjunto de tiles
+        
+        Só as duas imagens decodificadas ficam inteiras na memória (mais os índices do
+        alinhamento, alguns bytes por linha); diff e composição existem apenas para a faixa atual.
+        """
+        timer = timer or StageTimer()
+        with timer.span('diff.align', page_name, 'diff'):
+            hml_img, prod_index, hml_index, states = prepare_alignment(prod_img, hml_img)
+        width = prod_img.shape[1]
+        total_rows = len(states)
+        
+        base, ext = os.path.splitext(output_path)
+        images = []
+        thumbnail_parts = []
+        regions = []
+        diff_pixels = 0
+        
+        # Um span por etapa somando todas as faixas, em vez de um por tile
+        tile_stages = {'diff.mask': 0.0, 'diff.compose': 0.0, 'diff.write': 0.0}
+        tiles_start = time.time()
+        for tile_index, y0 in enumerate(range(0, total_rows, strip_height), 1):
+            y1 = min(y0 + strip_height, total_rows)
+            started = time.perf_counter()
+            prod_strip = aligned_strip(prod_img, prod_index[y0:y1])
+            hml_strip = aligned_strip(hml_img, hml_index[y0:y1])
+            mask = diff_mask(prod_strip, hml_strip, states[y0:y1])
+            diff_pixels += int(np.count_nonzero(mask))
+            strip_regions = find_regions(mask, y_offset=y0)
+            regions.extend(strip_regions)
+            del mask
+            tile_stages['diff.mask'] += time.perf_counter() - started
+            
+            started = time.perf_counter()
+            tile = np.hstack([prod_strip, state_separator(states[y0:y1]), hml_strip])
+            draw_regions(tile, strip_regions, width, y_offset=y0)
+            # A miniatura é montada com os tiles já reduzidos, sem remontar a página inteira
+            thumbnail_parts.append(downscale(tile))
+            tile_stages['diff.compose'] += time.perf_counter() - started
+            
+            started = time.perf_counter()
+            tile_path = f"{base}_{tile_index:03d}{ext}"
+            cv2.imwrite(tile_path, tile)
+            images.append(os.path.basename(tile_path))
+            tile_stages['diff.write'] += time.perf_counter() - started
+            del prod_strip, hml_strip, tile
+        for stage, seconds in tile_stages.items():
+            timer.record(stage, seconds * 1000, page_name, 'diff', tiles_start)
+            tiles_start += seconds
+        
+        diff_percentage = diff_pixels / (total_rows * width) * 100 if total_rows else 0.0
+        
+        # O cabeçalho depende do percentual final, então vira o primeiro tile
+        header = comparison_header(width * 2 + 20, width, page_name, diff_percentage)
+        header_path = f"{base}_000{ext}"
+        cv2.imwrite(header_path, header)
+        with timer.span('diff.thumbnail', page_name, 'diff'):
+            thumbnail = save_thumbnail([downscale(header)] + thumbnail_parts, f"{base}_thumb.webp")
+        
+        # Regiões cortadas na divisa entre faixas são unidas antes de pontuar e recortar
+        with timer.span('diff.regions', page_name, 'diff'):
+            regions = score_regions(merge_regions(regions), prod_index, hml_index)
+        with timer.span('diff.region_crops', page_name, 'diff'):
+            region_images = save_region_crops(prod_img, hml_img, prod_index, hml_index, regions, base, ext)
+        return {'diff_percentage': float(diff_percentage), 'images': [os.path.basename(header_path)] + images,
+                'thumbnail': thumbnail, 'regions': regions, 'region_images': region_images}
     
     # (Dentro da classe BulkVisualComparator)
 
+    def discover_to_file(self, path):
+        """Só a descoberta: grava a lista de páginas para os shards usarem com --urls
+        
+        Uma URL por linha (com o par de homologação, se houver mapeamento), no formato de load_url_list.
+        """
+        pages = asyncio.run(self._discover_async())
+        with open(path, 'w', encoding='utf-8') as f:
+            for url in pages:
+                hml_url = self.hml_urls.get(url)
+                f.write(f"{url}\t{hml_url}\n" if hml_url else f"{url}\n")
+        print(f"📝 {len(pages)} páginas gravadas em {path}")
+        return pages
+
+    async def _discover_async(self):
+        from playwright.async_api import async_playwright
+        
+        await self.resolve_protocols()
+        if self.urls is not None:
+            pages, self.hml_urls = self.expand_targets(self.urls)
+            return pages
+        async with async_playwright() as p:
+            browser = await p.chromium.launch(headless=True)
+            try:
+                return await self.discover_pages(browser)
+            finally:
+                await browser.close()
+
     def run_comparison(self):
         """Executa a comparação completa"""
         print(f"🚀 Iniciando comparação: {self.prod_domain} vs {self.hml_domain}")
+        print(f"⚙️  Workers paralelos: {self.workers}")
 
         # Cria os diretórios de resultados de forma segura
-        screenshots_dir = os.path.join(self.results_dir, 'screenshots')
-        comparisons_dir = os.path.join(self.results_dir, 'comparisons')
-        os.makedirs(screenshots_dir, exist_ok=True)
-        os.makedirs(comparisons_dir, exist_ok=True)
+        os.makedirs(os.path.join(self.results_dir, 'screenshots'), exist_ok=True)
+        os.makedirs(os.path.join(self.results_dir, 'comparisons'), exist_ok=True)
+
+        if self.baseline_store:
+            evicted = self.baseline_store.evict()
+            if evicted:
+                print(f"🧹 {evicted} baselines antigos removidos")
+        if self.cache_dir:
+            evicted = DiffCache(os.path.join(self.cache_dir, 'diffs'), max_age_days=self.diff_cache_max_age_days,
+                                max_bytes=self.diff_cache_max_bytes).evict()
+            if evicted:
+                print(f"🧹 {evicted} diffs antigos removidos do cache")
+
+        if not (self.resume_state and self.resume_state['run']):
+            self.journal.append('run', prod_domain=self.prod_domain, hml_domain=self.hml_domain,
+                                max_pages=self.max_pages, viewports=self.viewports, browsers=self.browsers,
+                                diff_mode=self.diff_mode, shard=self.shard)
 
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=True)
+        results = asyncio.run(self._run_comparison_async())
+        if results is None:
+            return None
+        
+        self.generate_report(results)
+        stages = self.timer.export(self.results_dir)
+        
+        print(f"\n🎉 Comparação concluída!")
+        if self.run_stats:
+            print(f"⏱️  {self.run_stats['processed']} páginas em {self.run_stats['elapsed_seconds']:.1f}s "
+                  f"({self.run_stats['pages_per_minute']:.1f} páginas/minuto)")
+        # As etapas mais caras no total, para saber onde o tempo foi parar
+        slowest = sorted(stages.items(), key=lambda item: item[1]['total'], reverse=True)[:5]
+        for stage, stats in slowest:
+            print(f"   ⏱️  {stage}: p50 {stats['p50']:.0f} ms, p95 {stats['p95']:.0f} ms, "
+                  f"máx {stats['max']:.0f} ms ({stats['count']}x)")
+        print(f"📁 Resultados salvos em: {self.results_dir}")
+        return results
+
+    async def _run_comparison_async(self):
+        """Descobre as páginas e executa o pipeline captura -> fila -> pool de processos de diff"""
+        from playwright.async_api import async_playwright
+        
+        await self.resolve_protocols()
+        async with async_playwright() as p:
+            # Cada navegador da matriz é lançado uma única vez e compartilhado por todos os perfis
+            browsers = {}
+            for name in dict.fromkeys(profile['browser'] for profile in self.profiles):
+                browsers[name] = await getattr(p, name).launch(headless=True)
+            browser = browsers.get('chromium') or next(iter(browsers.values()))
             
-            pages = self.discover_pages(browser)
+            # Na retomada a lista de páginas vem do diário; resultados já gravados são pulados
+            resume = self.resume_state or {}
+            pages = resume.get('pages')
+            if pages:
+                print(f"♻️  Retomando {self.results_dir}: {len(pages)} páginas no diário")
+                self.found_urls = set(pages)
+                self.hml_urls = resume.get('hml_urls') or {}
+            else:
+                if self.urls is not None:
+                    # Lista pronta de páginas: nada de sitemap nem crawling
+                    pages, self.hml_urls = self.expand_targets(self.urls)
+                    self.found_urls = set(pages)
+                    print(f"📋 {len(pages)} páginas vindas da lista de URLs")
+                else:
+                    pages = await self.discover_pages(browser)
+                if pages:
+                    self.journal.append('pages', urls=pages, hml_urls=self.hml_urls)
             
             if not pages:
                 print("❌ Nenhuma página encontrada!")
-                browser.close()
-                return
+                for running in browsers.values():
+                    await running.close()
+                return None
+            
+            # Uma captura por página e perfil; falhas da execução anterior são tentadas de novo
+            # Os índices continuam globais (lista inteira), então os nomes não colidem entre shards
+            shard_pages = [(i, url) for i, url in enumerate(pages, 1) if self.in_shard(url)]
+            if self.shard:
+                print(f"🧩 Shard {self.shard[0]}/{self.shard[1]}: {len(shard_pages)} de {len(pages)} páginas")
+            profile_keys = {profile['key'] for profile in self.profiles}
+            results = {key: result for key, result in resume.get('results', {}).items()
+                       if result['success'] and key[0] <= len(pages) and self._profile_key(key[1]) in profile_keys}
+            pending = [(i, url, profile) for i, url in shard_pages for profile in self.profiles
+                       if (i, self._result_profile(profile)) not in results]
+            if results:
+                print(f"⏭️  {len(results)} capturas já concluídas, {len(pending)} restantes")
+            
+            # Um pool de contextos por perfil e ambiente; com vários perfis os contextos
+            # são criados sob demanda, então perfis pouco usados não ocupam memória
+            pools = {}
+            for profile in self.profiles:
+                context_options = {'ignore_https_errors': True, **profile['context_options']}
+                for env in ('prod', 'hml'):
+                    pool = ContextPool(browsers[profile['browser']], self.workers,
+                                       interceptor=self.interceptor, **context_options)
+                    await pool.start(None if len(self.profiles) == 1 else 0)
+                    pools[(profile['key'], env)] = pool
+            
+            # O relatório é escrito conforme os resultados chegam
+            self.report_writer = ReportWriter(self.results_dir, self.prod_domain, self.hml_domain)
+            self.report_writer.start(len(shard_pages) * len(self.profiles),
+                                     profiles=[profile['key'] for profile in self.profiles])
+            for key in sorted(results, key=lambda key: (key[0], key[1] or '')):
+                self.report_writer.add(results[key])
+            
+            # Gravação dos screenshots brutos é opcional e acontece em segundo plano
+            self.screenshot_writer = ScreenshotWriter(self.screenshot_format, self.screenshot_compression,
+                                                      timer=self.timer) if self.save_screenshots else None
+            
+            # Perfis da mesma página ficam juntos na fila: o cache de assets já está quente
+            jobs = asyncio.Queue()
+            for job in pending:
+                jobs.put_nowait(job)
             
-            results = []
+            # Fila limitada: se o diff ficar para trás, as capturas esperam (backpressure)
+            diff_queue = asyncio.Queue(maxsize=self.diff_queue_size)
             total_pages = len(pages)
+            loop = asyncio.get_running_loop()
+            started = time.perf_counter()
             
-            for i, prod_url in enumerate(pages, 1):
-                parsed_prod = urlparse(prod_url)
-                
-                hml_url = f"{self.hml_protocol}://{self.hml_domain}{parsed_prod.path}"
-                if parsed_prod.query:
-                    hml_url += f"?{parsed_prod.query}"
-                
-                page_path = parsed_prod.path.strip('/').replace('/', '_')
-                if not page_path:
-                    page_path = 'home'
-                page_name = f"{page_path}_{i:02d}"
-                
-                print(f"\n📄 [{i}/{total_pages}] Processando: {page_name}")
-                print(f"  PROD: {prod_url}")
-                print(f"  HML:  {hml_url}")
-                
-                # --- MUDANÇA PRINCIPAL AQUI ---
-                # Usa os.path.join para criar os caminhos dos arquivos
-                prod_screenshot = os.path.join(screenshots_dir, f"prod_{page_name}.png")
-                hml_screenshot = os.path.join(screenshots_dir, f"hml_{page_name}.png")
-                comparison_path = os.path.join(comparisons_dir, f"{page_name}_comparison.png")
-                
-                print("  📸 Capturando produção...")
-                prod_success = self.capture_screenshot(browser, prod_url, prod_screenshot)
-                
-                print("  📸 Capturando homologação...")
-                hml_success = self.capture_screenshot(browser, hml_url, hml_screenshot)
-                
-                if prod_success and hml_success:
-                    print("  🔄 Criando comparação...")
-                    diff_percentage = self.create_side_by_side_comparison(
-                        prod_screenshot, hml_screenshot, comparison_path, page_name
-                    )
-                    
-                    results.append({
-                        'page': page_name,
-                        'prod_url': prod_url,
-                        'hml_url': hml_url,
-                        'diff_percentage': diff_percentage,
-                        'success': True
-                    })
-                    print(f"  ✅ Concluído - Diferença: {diff_percentage:.1f}%")
-                else:
-                    results.append({
-                        'page': page_name,
-                        'prod_url': prod_url,
-                        'hml_url': hml_url,
-                        'diff_percentage': None,
-                        'success': False
-                    })
-                    print(f"  ❌ Falhou")
-                
-                time.sleep(1)
+            async def capture_worker():
+                while True:
+                    try:
+                        i, prod_url, profile = jobs.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    job = await self.capture_page(pools[(profile['key'], 'prod')], pools[(profile['key'], 'hml')],
+                                                  i, total_pages, prod_url, profile)
+                    self.journal.append('capture', index=i, page=job['page'], captured=job['captured'],
+                                        prod_source=job['prod_source'], capture_profile=job['capture_profile'])
+                    if job['fast_path']:
+                        # Mesma impressão digital nos dois ambientes: nada para comparar
+                        outcome = {'diff_percentage': 0.0, 'images': [], 'cache': 'fingerprint'}
+                        results[(i, job['capture_profile'])] = self._page_result(job, outcome)
+                    elif job['captured']:
+                        await diff_queue.put(job)
+                    else:
+                        results[(i, job['capture_profile'])] = self._page_result(job, None)
+            
+            # O pool de diff é recriado se um processo morrer (ex.: OOM); o dict é compartilhado
+            # pelos workers para que só o primeiro a perceber troque o pool
+            diff_pool = {'executor': diff_process_pool(self.diff_workers)}
+            
+            async def run_diff(job):
+                # Segunda tentativa num pool novo: a página que derrubou o pool pode não ser esta
+                for attempt in range(2):
+                    executor = diff_pool['executor']
+                    try:
+                        return await loop.run_in_executor(executor, diff_pair, job)
+                    except BrokenProcessPool:
+                        if diff_pool['executor'] is executor:
+                            print(f"  💥 Processo de diff morreu ({job['page']}); recriando o pool")
+                            executor.shutdown(wait=False)
+                            diff_pool['executor'] = diff_process_pool(self.diff_workers)
+                    except Exception as e:
+                        print(f"  ❌ Erro no diff de {job['page']}: {e}")
+                        return None
+                return None
+            
+            async def diff_worker():
+                while True:
+                    job = await diff_queue.get()
+                    if job is None:
+                        return
+                    print(f"  🔄 Criando comparação ({job['page']})...")
+                    outcome = await run_diff(job)
+                    results[(job['index'], job['capture_profile'])] = self._page_result(job, outcome)
+            
+            try:
+                diff_tasks = [asyncio.create_task(diff_worker()) for _ in range(self.diff_workers)]
+                try:
+                    await asyncio.gather(*(capture_worker() for _ in range(min(self.workers, len(pending)))))
+                finally:
+                    for pool in pools.values():
+                        await pool.close()
+                    # Fecha os navegadores assim que as capturas terminam; o diff segue sozinho
+                    for running in browsers.values():
+                        await running.close()
+                    for _ in diff_tasks:
+                        await diff_queue.put(None)
+                    await asyncio.gather(*diff_tasks)
+                    if self.screenshot_writer:
+                        await asyncio.to_thread(self.screenshot_writer.close)
+            finally:
+                diff_pool['executor'].shutdown()
             
-            # Fecha o navegador no final de tudo
-            browser.close()
+            elapsed = time.perf_counter() - started
+            self.run_stats = {
+                'pages': len(shard_pages),
+                'profiles': len(self.profiles),
+                'processed': len(pending),
+                'resumed': len(shard_pages) * len(self.profiles) - len(pending),
+                'workers': self.workers,
+                'diff_workers': self.diff_workers,
+                'elapsed_seconds': elapsed,
+                'pages_per_minute': len(pending) / (elapsed / 60) if elapsed > 0 else 0.0,
+            }
         
-        self.generate_report(results)
+        return [results[key] for key in sorted(results, key=lambda key: (key[0], key[1] or ''))]
+
+    def _result_profile(self, profile):
+        """Perfil gravado no resultado; None na execução de perfil único (nomes de arquivo sem sufixo)"""
+        return profile['key'] if len(self.profiles) > 1 else None
+
+    def _profile_key(self, result_profile):
+        return result_profile or self.profiles[0]['key']
+
+    async def capture_page(self, prod_pool, hml_pool, i, total_pages, prod_url, profile=None):
+        """Captura produção e homologação da mesma página em paralelo e devolve o job de diff"""
+        profile = profile or self.profiles[0]
+        screenshots_dir = os.path.join(self.results_dir, 'screenshots')
+        comparisons_dir = os.path.join(self.results_dir, 'comparisons')
+        parsed_prod = urlparse(prod_url)
         
-        print(f"\n🎉 Comparação concluída!")
-        print(f"📁 Resultados salvos em: {self.results_dir}")
+        hml_url = self.hml_urls.get(prod_url)
+        if not hml_url:
+            hml_url = f"{self.hml_protocol}://{self.hml_domain}{parsed_prod.path}"
+            if parsed_prod.query:
+                hml_url += f"?{parsed_prod.query}"
+        
+        page_path = parsed_prod.path.strip('/').replace('/', '_')
+        if not page_path:
+            page_path = 'home'
+        page_name = f"{page_path}_{i:02d}"
+        # Com vários perfis, as saídas de cada um ficam separadas pelo sufixo do perfil
+        capture_profile = self._result_profile(profile)
+        if capture_profile:
+            page_name = f"{page_name}_{capture_profile}"
+        
+        print(f"\n📄 [{i}/{total_pages}] Processando: {page_name}")
+        print(f"  PROD: {prod_url}")
+        print(f"  HML:  {hml_url}")
+        
+        # Usa os.path.join para criar os caminhos dos arquivos
+        job = {
+            'index': i,
+            'page': page_name,
+            'capture_profile': capture_profile,
+            'prod_url': prod_url,
+            'hml_url': hml_url,
+            'output_path': os.path.join(comparisons_dir, f"{page_name}_comparison.png"),
+            'diff_mode': self.diff_mode,
+            'strip_height': self.strip_height,
+            'cache_dir': os.path.join(self.cache_dir, 'diffs') if self.cache_dir else None,
+            'phash_threshold': self.phash_threshold,
+            'profile': self.profile_diff,
+            'profile_dir': os.path.join(self.results_dir, 'profiles'),
+        }
+        
+        # Cada lado publica sua impressão digital e espera a do outro; um lado que termina sem
+        # publicar (baseline reaproveitado, falha) libera o outro com None
+        fingerprints = None
+        if self.fingerprint:
+            loop = asyncio.get_running_loop()
+            fingerprints = {'prod': loop.create_future(), 'hml': loop.create_future()}
+        
+        async def side(env, capture):
+            try:
+                return await capture
+            finally:
+                if fingerprints and not fingerprints[env].done():
+                    fingerprints[env].set_result(None)
+        
+        print(f"  📸 Capturando produção e homologação ({page_name})...")
+        prod_capture, hml_capture = await asyncio.gather(
+            side('prod', self.capture_production(prod_pool, prod_url, page_name, profile, fingerprints)),
+            side('hml', self.capture_screenshot(hml_pool, hml_url, page_name, 'hml', fingerprints)),
+        )
+        job['prod_image'] = prod_capture['image'] if prod_capture else None
+        job['hml_image'] = hml_capture['image'] if hml_capture else None
+        job['prod_source'] = prod_capture['source'] if prod_capture else None
+        job['readiness'] = {
+            'prod': prod_capture.get('readiness') if prod_capture else None,
+            'hml': hml_capture.get('readiness') if hml_capture else None,
+        }
+        job['fast_path'] = bool(prod_capture and hml_capture and
+                                prod_capture['source'] == hml_capture['source'] == 'fingerprint')
+        job['captured'] = job['fast_path'] or (job['prod_image'] is not None and job['hml_image'] is not None)
+        
+        if self.screenshot_writer:
+            extension = self.screenshot_writer.extension
+            for env in ('prod', 'hml'):
+                if job[f'{env}_image'] is not None:
+                    path = os.path.join(screenshots_dir, f"{env}_{page_name}{extension}")
+                    self.screenshot_writer.save(job[f'{env}_image'], path, page_name, env)
+        return job
+
+    def _page_result(self, job, outcome):
+        """Monta a linha de resultado de uma página e a anexa ao relatório em andamento"""
+        outcome = outcome or {}
+        # Os spans do diff vêm do processo do pool junto com o resultado
+        self.timer.extend(outcome.get('timings', []))
+        diff_percentage = outcome.get('diff_percentage')
+        if diff_percentage is not None:
+            print(f"  ✅ {job['page']} concluído - Diferença: {diff_percentage:.1f}%")
+        else:
+            print(f"  ❌ {job['page']} falhou")
+        result = {
+            'index': job['index'],
+            'page': job['page'],
+            'capture_profile': job.get('capture_profile'),
+            'prod_url': job['prod_url'],
+            'hml_url': job['hml_url'],
+            'diff_percentage': diff_percentage,
+            'images': outcome.get('images', []),
+            'thumbnail': outcome.get('thumbnail'),
+            'cache': outcome.get('cache'),
+            'regions': outcome.get('regions', []),
+            'regions_file': outcome.get('regions_file'),
+            'prod_source': job.get('prod_source'),
+            'readiness': job.get('readiness'),
+            'timings': self.timer.page_spans(job['page']),
+            'diff_peak_rss': outcome.get('peak_rss'),
+            'profile': outcome.get('profile'),
+            'success': diff_percentage is not None
+        }
+        self.journal.append('result', result=result)
+        if self.report_writer:
+            self.report_writer.add(result)
+        return result
     
+    def report_stats(self):
+        """Estatísticas da execução usadas no resumo do relatório e no results.json"""
+        return {
+            'run': self.run_stats,
+            'assets': dict(self.interceptor.stats),
+            'hosts': self.rate_limiter.stats(),
+            'stages': self.timer.summary(),
+        }
+
     def generate_report(self, results):
-        """Gera relatório HTML dos resultados"""
-        html_content = f"""
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>Relatório de Comparação Visual</title>
-            <style>
-                body {{ font-family: Arial, sans-serif; margin: 20px; }}
-                .header {{ background: #f0f0f0; padding: 15px; border-radius: 5px; }}
-                .result {{ margin: 15px 0; padding: 15px; border: 1px solid #ddd; border-radius: 5px; }}
-                .success {{ border-left: 5px solid #4CAF50; }}
-                .error {{ border-left: 5px solid #f44336; }}
-                .high-diff {{ border-left: 5px solid #ff9800; }}
-                .comparison-img {{ max-width: 100%; margin: 10px 0; }}
-                .stats {{ display: flex; gap: 20px; margin: 10px 0; }}
-                .stat {{ background: #e3f2fd; padding: 10px; border-radius: 3px; }}
-            </style>
-        </head>
-        <body>
-            <div class="header">
-                <h1>Comparação Visual: {self.prod_domain} vs {self.hml_domain}</h1>
-                <p><strong>Data:</strong> {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}</p>
-                <p><strong>Total de páginas:</strong> {len(results)}</p>
-            </div>
-        """
-        
-        # Estatísticas
-        successful = [r for r in results if r['success']]
-        failed = [r for r in results if not r['success']]
-        high_diff = [r for r in successful if r['diff_percentage'] and r['diff_percentage'] > 10]
+        """Gera relatório HTML dos resultados
         
-        html_content += f"""
-            <div class="stats">
-                <div class="stat">
-                    <strong>Sucessos:</strong> {len(successful)}
-                </div>
-                <div class="stat">
-                    <strong>Falhas:</strong> {len(failed)}
-                </div>
-                <div class="stat">
-                    <strong>Grandes diferenças (>10%):</strong> {len(high_diff)}
-                </div>
-            </div>
+        Durante run_comparison o relatório já foi sendo escrito página a página; aqui ele é
+        finalizado. Chamado avulso, gera o relatório inteiro a partir da lista de resultados.
         """
+        with self.timer.span('report'):
+            writer = self.report_writer
+            if writer is None:
+                writer = ReportWriter(self.results_dir, self.prod_domain, self.hml_domain)
+                writer.start(len(results), sorted({r['capture_profile'] for r in results if r.get('capture_profile')}))
+                for result in results:
+                    writer.add(result)
+            writer.finish(self.report_stats())
+            self.report_writer = None
+
+def diff_process_pool(max_workers):
+    """Pool de processos do diff, iniciado por forkserver (ou spawn) em vez de fork
+    
+    Quando o pool é criado o processo já tem o loop do Playwright e pools de threads rodando;
+    um fork herdaria locks presos (stdio, pools de threads do OpenCV) nos processos filhos.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+
+
+def diff_pair(job):
+    """Compara um par de screenshots; roda dentro de um processo do pool de diff
+    
+    Além da imagem de comparação grava <pagina>_regions.json com as regiões alteradas.
+    Com job['profile'] = 'cprofile' ou 'tracemalloc', grava também o perfil do diff em profile_dir.
+    """
+    timer = StageTimer()
+    profile = job.get('profile')
+    if profile == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        outcome = profiler.runcall(compare_pair, job, timer)
+    elif profile == 'tracemalloc':
+        import tracemalloc
+        tracemalloc.start(10)
+        try:
+            outcome = compare_pair(job, timer)
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    else:
+        outcome = compare_pair(job, timer)
+    if outcome is None:
+        return None
+    outcome['timings'] = timer.spans
+    # Pico do processo do pool até aqui; o maior entre as páginas é o pico do estágio de diff
+    outcome['peak_rss'] = peak_rss()
+    
+    if profile in ('cprofile', 'tracemalloc'):
+        os.makedirs(job['profile_dir'], exist_ok=True)
+        if profile == 'cprofile':
+            profile_path = os.path.join(job['profile_dir'], f"{job['page']}.prof")
+            profiler.dump_stats(profile_path)
+        else:
+            profile_path = os.path.join(job['profile_dir'], f"{job['page']}_memory.txt")
+            with open(profile_path, 'w', encoding='utf-8') as f:
+                f.write(f"Pico de memória: {peak / 1024 ** 2:.1f} MB\n\n")
+                for stat in snapshot.statistics('lineno')[:25]:
+                    f.write(f"{stat}\n")
+            outcome['memory_peak'] = peak
+        outcome['profile'] = os.path.relpath(profile_path, os.path.dirname(job['profile_dir']))
+    outcome.setdefault('regions', [])
+    outcome.setdefault('region_images', [])
+    
+    regions_path = os.path.join(os.path.dirname(job['output_path']), f"{job['page']}_regions.json")
+    with open(regions_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'page': job['page'],
+            'prod_url': job.get('prod_url'),
+            'hml_url': job.get('hml_url'),
+            'diff_percentage': outcome['diff_percentage'],
+            'cache': outcome.get('cache'),
+            'images': outcome['images'],
+            'regions': outcome['regions'],
+        }, f, ensure_ascii=False, indent=2)
+    outcome['regions_file'] = os.path.basename(regions_path)
+    return outcome
+
+
+def compare_pair(job, timer=None):
+    """Diff de um par de screenshots passando antes pelos atalhos baratos
+    
+    Pixels idênticos, cache por conteúdo e (se configurado) distância do dHash abaixo do limite.
+    """
+    page_name = job['page']
+    timer = timer or StageTimer()
+    with timer.span('diff.decode', page_name, 'diff'):
+        prod_img = load_image(job['prod_image'])
+        hml_img = load_image(job['hml_image'])
+    if prod_img is None or hml_img is None:
+        print(f"    ❌ Erro ao carregar imagens para {page_name}")
+        return None
+    
+    diff_mode = job.get('diff_mode', 'auto')
+    strip_height = job.get('strip_height', TILE_HEIGHT)
+    
+    # Pixels idênticos: 0% sem montar nem gravar a imagem de comparação
+    with timer.span('diff.pixel_hash', page_name, 'diff'):
+        prod_hash, hml_hash = pixel_hash(prod_img), pixel_hash(hml_img)
+    if prod_hash == hml_hash:
+        return {'diff_percentage': 0.0, 'images': [], 'cache': 'identical'}
+    
+    phash_threshold = job.get('phash_threshold')
+    if phash_threshold is not None:
+        with timer.span('diff.dhash', page_name, 'diff'):
+            distance = hamming_distance(dhash(prod_img), dhash(hml_img))
+        if distance <= phash_threshold:
+            return {'diff_percentage': 0.0, 'images': [], 'cache': 'phash', 'phash_distance': distance}
+    
+    cache = DiffCache(job['cache_dir']) if job.get('cache_dir') else None
+    cache_key = DiffCache.key(prod_hash, hml_hash, diff_mode, strip_height) if cache else None
+    if cache:
+        with timer.span('diff.cache_get', page_name, 'diff'):
+            cached = cache.get(cache_key, job['output_path'], page_name, prod_img.shape[1])
+        if cached is not None:
+            cached['cache'] = 'hit'
+            return cached
+    
+    outcome = BulkVisualComparator.create_side_by_side_comparison(
+        prod_img, hml_img, job['output_path'], page_name,
+        diff_mode=diff_mode, strip_height=strip_height, timer=timer
+    )
+    if outcome is None:
+        return None
+    if cache:
+        with timer.span('diff.cache_put', page_name, 'diff'):
+            cache.put(cache_key, job['output_path'], outcome, page_name)
+    outcome['cache'] = 'miss' if cache else None
+    return outcome
+
+def load_url_list(path):
+    """Lê a lista de páginas do modo batch: uma por linha, opcionalmente com o par de homologação
+    
+    Cada linha é uma URL ou caminho de produção ('/produtos'), opcionalmente seguida (separada
+    por espaço, tab ou vírgula) da URL ou caminho correspondente em homologação. Linhas vazias
+    e iniciadas por '#' são ignoradas. Devolve uma lista de (produção, homologação ou None).
+    """
+    entries = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = re.split(r'[\s,]+', line)
+            entries.append((parts[0], parts[1] if len(parts) > 1 else None))
+    return entries
+
+
+# Opções do modo batch que não são parâmetros do BulkVisualComparator
+BATCH_ONLY_OPTIONS = ('prod', 'hml', 'urls', 'fail_threshold', 'allow_failures')
+
+
+def load_batch_config(path):
+    """Lê a configuração JSON do modo batch e valida as chaves contra os parâmetros do comparador"""
+    import inspect
+    with open(path, encoding='utf-8') as f:
+        config = json.load(f)
+    accepted = set(inspect.signature(BulkVisualComparator.__init__).parameters) - {'self'}
+    unknown = set(config) - accepted - set(BATCH_ONLY_OPTIONS)
+    if unknown:
+        raise ValueError(f"opções desconhecidas em {path}: {', '.join(sorted(unknown))}")
+    return config
+
+
+def batch_exit_code(results, fail_threshold=HIGH_DIFF_THRESHOLD, allow_failures=False):
+    """Código de saída do modo batch
+    
+    0 = tudo abaixo do limite, 1 = alguma página acima do limite de diferença,
+    2 = páginas que não puderam ser capturadas/comparadas, 3 = nenhuma página comparada.
+    """
+    if not results:
+        print("❌ Nenhuma página comparada")
+        return 3
+    failed = [r for r in results if not r['success']]
+    above = [r for r in results if r['success'] and r['diff_percentage'] > fail_threshold]
+    for result in above:
+        print(f"   ❌ {result['page']}: {result['diff_percentage']:.1f}% (limite {fail_threshold}%)")
+    for result in failed:
+        print(f"   ❌ {result['page']}: falha na captura ou no diff")
+    if above:
+        return 1
+    if failed and not allow_failures:
+        return 2
+    print(f"✅ {len(results) - len(failed)} páginas dentro do limite de {fail_threshold}%")
+    return 0
+
+
+def batch_config(args):
+    """Configuração do modo batch: arquivo JSON + flags (que têm prioridade) + diário da retomada"""
+    config = load_batch_config(args.config) if args.config else {}
+    # Flags passadas explicitamente sobrescrevem o arquivo de configuração
+    overrides = {
+        'prod': args.prod, 'hml': args.hml, 'urls': args.urls, 'max_pages': args.max_pages,
+        'workers': args.workers, 'max_rate': args.max_rate, 'diff_workers': args.diff_workers, 'diff_mode': args.diff_mode,
+        'cache_dir': args.cache_dir, 'phash_threshold': args.phash_threshold,
+        'fail_threshold': args.fail_threshold, 'profile_diff': args.profile_diff,
+        'viewports': args.viewports.split(',') if args.viewports else None,
+        'browsers': args.browsers.split(',') if args.browsers else None,
+        'shard': args.shard, 'results_dir': args.results_dir,
+    }
+    config.update({key: value for key, value in overrides.items() if value is not None})
+    if args.no_cache:
+        config['cache_dir'] = None
+    if args.no_screenshots:
+        config['save_screenshots'] = False
+    if args.allow_failures:
+        config['allow_failures'] = True
+    if args.fingerprint or args.fingerprint_mask:
+        config['fingerprint'] = {'mask_selectors': [*DEFAULT_FINGERPRINT_MASK_SELECTORS, *(args.fingerprint_mask or [])]}
+    
+    if args.resume:
+        run = RunJournal.load(args.resume)['run']
+        if not run:
+            raise ValueError(f"nenhum diário de execução encontrado em {args.resume}")
+        config.setdefault('prod', run['prod_domain'])
+        config.setdefault('hml', run['hml_domain'])
+        config.setdefault('max_pages', run['max_pages'])
+        # A matriz de perfis precisa ser a mesma para casar com os resultados do diário
+        for key in ('viewports', 'browsers', 'shard'):
+            if run.get(key):
+                config.setdefault(key, run[key])
+        config['resume_dir'] = args.resume
+    if not config.get('prod') or not config.get('hml'):
+        raise ValueError("informe os domínios de produção e homologação (--prod/--hml ou no --config)")
+    if isinstance(config.get('shard'), str):
+        config['shard'] = parse_shard(config['shard'])
+    return config
+
+
+def create_comparator(config):
+    urls = config.get('urls')
+    if isinstance(urls, str):
+        urls = load_url_list(urls)
+    elif urls is not None:
+        # Na configuração JSON a lista pode vir direto: "url" ou ["prod", "hml"]
+        urls = [(url, None) if isinstance(url, str) else tuple(url) for url in urls]
+    
+    options = {key: value for key, value in config.items() if key not in BATCH_ONLY_OPTIONS}
+    return BulkVisualComparator(config['prod'], config['hml'], urls=urls, **options)
+
+
+def run_batch(args):
+    """Modo não interativo: configuração por arquivo e/ou flags, código de saída pelos limites"""
+    config = batch_config(args)
+    comparator = create_comparator(config)
+    if args.discover_only:
+        comparator.discover_to_file(args.discover_only)
+        return 0
+    results = comparator.run_comparison()
+    return batch_exit_code(results, config.get('fail_threshold', HIGH_DIFF_THRESHOLD),
+                           config.get('allow_failures', False))
+
+
+def merge_results(shard_dirs, output_dir):
+    """Junta os resultados parciais dos shards num único relatório, results.json e timings
+    
+    Os resultados vêm do diário de cada shard (sempre atualizado, mesmo se o shard caiu no meio);
+    as estatísticas vêm do results.json final. As imagens são copiadas para output_dir.
+    """
+    os.makedirs(os.path.join(output_dir, 'comparisons'), exist_ok=True)
+    merged, runs, assets, hosts = {}, [], {}, {}
+    timer = StageTimer()
+    prod_domain = hml_domain = None
+    for shard_dir in shard_dirs:
+        state = RunJournal.load(shard_dir)
+        if not state['run']:
+            raise ValueError(f"nenhum diário de execução encontrado em {shard_dir}")
+        prod_domain = prod_domain or state['run']['prod_domain']
+        hml_domain = hml_domain or state['run']['hml_domain']
+        merged.update(state['results'])
         
-        # Resultados individuais
-        for result in results:
-            if result['success']:
-                diff = result['diff_percentage']
-                css_class = 'high-diff' if diff and diff > 10 else 'success'
-                
-                html_content += f"""
-                    <div class="result {css_class}">
-                        <h3>{result['page']}</h3>
-                        <p><strong>Diferença:</strong> {diff:.1f}%</p>
-                        <p><strong>Produção:</strong> <a href="{result['prod_url']}" target="_blank">{result['prod_url']}</a></p>
-                        <p><strong>Homologação:</strong> <a href="{result['hml_url']}" target="_blank">{result['hml_url']}</a></p>
-                        <img src="comparisons/{result['page']}_comparison.png" class="comparison-img" alt="{result['page']} comparison">
-                    </div>
-                """
-            else:
-                html_content += f"""
-                    <div class="result error">
-                        <h3>{result['page']} - ERRO</h3>
-                        <p><strong>Produção:</strong> {result['prod_url']}</p>
-                        <p><strong>Homologação:</strong> {result['hml_url']}</p>
-                        <p>Falha ao capturar screenshots</p>
-                    </div>
-                """
-        
-        html_content += """
-        </body>
-        </html>
-        """
+        results_path = os.path.join(shard_dir, 'results.json')
+        stats = {}
+        if os.path.exists(results_path):
+            with open(results_path, encoding='utf-8') as f:
+                payload = json.load(f)
+            stats = payload.get('stats', {})
+            if not payload.get('complete'):
+                print(f"⚠️  {shard_dir} não terminou; usando os resultados parciais do diário")
+        if stats.get('run'):
+            runs.append(stats['run'])
+        for key, value in stats.get('assets', {}).items():
+            assets[key] = assets.get(key, 0) + value
+        # Os shards batem nos mesmos hosts ao mesmo tempo: as taxas se somam
+        for host, host_stats in stats.get('hosts', {}).items():
+            combined = hosts.setdefault(host, dict.fromkeys(host_stats, 0))
+            for key, value in host_stats.items():
+                combined[key] = max(combined[key], value) if key == 'latency_ms' else combined[key] + value
+        timings_path = os.path.join(shard_dir, 'timings.json')
+        if os.path.exists(timings_path):
+            with open(timings_path, encoding='utf-8') as f:
+                timer.extend(json.load(f)['spans'])
         
-        # Salva relatório
-        report_path = os.path.join(self.results_dir, "relatorio.html")
+        for subdir in ('comparisons', 'screenshots', 'profiles'):
+            source = os.path.join(shard_dir, subdir)
+            if os.path.isdir(source):
+                shutil.copytree(source, os.path.join(output_dir, subdir), dirs_exist_ok=True)
+    
+    results = [merged[key] for key in sorted(merged, key=lambda key: (key[0], key[1] or ''))]
+    # Os shards rodam em paralelo: o tempo total é o do shard mais lento
+    elapsed = max((run.get('elapsed_seconds', 0) for run in runs), default=0)
+    processed = sum(run.get('processed', 0) for run in runs)
+    run_stats = {
+        'shards': len(shard_dirs),
+        'pages': sum(run.get('pages', 0) for run in runs),
+        'processed': processed,
+        'workers': sum(run.get('workers', 0) for run in runs),
+        'diff_workers': sum(run.get('diff_workers', 0) for run in runs),
+        'elapsed_seconds': elapsed,
+        'pages_per_minute': processed / (elapsed / 60) if elapsed > 0 else 0.0,
+    }
+    
+    writer = ReportWriter(output_dir, prod_domain, hml_domain)
+    writer.start(len(results), sorted({r['capture_profile'] for r in results if r.get('capture_profile')}))
+    for result in results:
+        writer.add(result)
+    writer.finish({'run': run_stats, 'assets': assets, 'hosts': hosts, 'stages': timer.summary()})
+    timer.export(output_dir)
+    print(f"🧩 {len(shard_dirs)} shards combinados: {len(results)} resultados em {output_dir}")
+    return results
+
+
+def run_merge(args):
+    output_dir = args.results_dir or f"comparison_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}_merged"
+    results = merge_results(args.merge, output_dir)
+    fail_threshold = args.fail_threshold if args.fail_threshold is not None else HIGH_DIFF_THRESHOLD
+    return batch_exit_code(results, fail_threshold, args.allow_failures)
+
+
+def strip_options(argv, options):
+    """Remove opções (e seus valores) de uma linha de comando, nas formas '--opt valor' e '--opt=valor'"""
+    stripped, skip = [], False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in options:
+            skip = True
+        elif not arg.split('=', 1)[0] in options:
+            stripped.append(arg)
+    return stripped
+
+
+def launch_shards(args, argv):
+    """Roda todos os shards nesta máquina, cada um num processo, e combina os resultados
+    
+    A descoberta roda uma única vez; os shards recebem a mesma lista via --urls.
+    """
+    import subprocess
+    
+    count = args.launch_shards
+    config = batch_config(args)
+    output_dir = config.get('results_dir') or \
+        f"comparison_results_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{count}shards"
+    config['results_dir'] = output_dir
+    os.makedirs(output_dir, exist_ok=True)
+    
+    urls_path = config.get('urls') if isinstance(config.get('urls'), str) else None
+    if not urls_path:
+        urls_path = os.path.join(output_dir, 'urls.txt')
+        create_comparator(config).discover_to_file(urls_path)
+    
+    child_argv = strip_options(argv, ('--launch-shards', '--results-dir', '--urls', '--shard', '--discover-only'))
+    processes = []
+    for index in range(1, count + 1):
+        shard_dir = os.path.join(output_dir, f"shard_{index}")
+        os.makedirs(shard_dir, exist_ok=True)
+        command = [sys.executable, os.path.abspath(__file__), *child_argv, '--urls', urls_path,
+                   '--shard', f"{index}/{count}", '--results-dir', shard_dir]
+        log = open(os.path.join(shard_dir, 'shard.log'), 'w', encoding='utf-8')
+        processes.append((index, shard_dir, log, subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)))
+        print(f"🚀 Shard {index}/{count} iniciado (log em {shard_dir}/shard.log)")
+    
+    for index, shard_dir, log, process in processes:
+        code = process.wait()
+        log.close()
+        status = '✅' if code in (0, 1, 2) else '❌'
+        print(f"{status} Shard {index}/{count} terminou com código {code}")
+    
+    results = merge_results([shard_dir for _, shard_dir, _, _ in processes], output_dir)
+    return batch_exit_code(results, config.get('fail_threshold', HIGH_DIFF_THRESHOLD),
+                           config.get('allow_failures', False))
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        description="Comparador visual em massa (produção vs homologação). "
+                    "Sem --prod/--hml/--config/--resume, roda no modo interativo."
+    )
+    parser.add_argument('--prod', help="domínio de produção (ex.: site.com.br ou https://site.com.br)")
+    parser.add_argument('--hml', help="domínio de homologação")
+    parser.add_argument('--config', help="arquivo JSON com as opções do comparador")
+    parser.add_argument('--urls', help="lista de URLs/caminhos (um por linha, opcionalmente com o par de "
+                                       "homologação); pula o crawling")
+    parser.add_argument('--max-pages', type=int, help="máximo de páginas descobertas")
+    parser.add_argument('--workers', type=int, help="páginas capturadas em paralelo")
+    parser.add_argument('--max-rate', type=float,
+                        help="teto de requisições/s por host (a taxa se ajusta sozinha abaixo dele)")
+    parser.add_argument('--diff-workers', type=int, help="processos de diff")
+    parser.add_argument('--diff-mode', choices=('auto', 'full', 'tiled'))
+    parser.add_argument('--viewports', help=f"viewports separadas por vírgula: {', '.join(VIEWPORT_PRESETS)} "
+                                            "ou LARGURAxALTURA (padrão: desktop)")
+    parser.add_argument('--browsers', help=f"navegadores separados por vírgula: {', '.join(SUPPORTED_BROWSERS)} "
+                                           "(padrão: chromium)")
+    parser.add_argument('--phash-threshold', type=int, help="distância dHash tratada como idêntica")
+    parser.add_argument('--cache-dir', help=f"diretório de cache (padrão: {DEFAULT_CACHE_DIR})")
+    parser.add_argument('--no-cache', action='store_true', help="desativa caches de diff, assets e baselines")
+    parser.add_argument('--no-screenshots', action='store_true', help="não grava os screenshots brutos")
+    parser.add_argument('--fail-threshold', type=float,
+                        help=f"diferença (%%) acima da qual sai com código 1 (padrão: {HIGH_DIFF_THRESHOLD})")
+    parser.add_argument('--allow-failures', action='store_true',
+                        help="páginas que falharam na captura não mudam o código de saída")
+    parser.add_argument('--results-dir', help="diretório de resultados (padrão: comparison_results_<data>)")
+    parser.add_argument('--shard', type=parse_shard, metavar='i/N',
+                        help="processa só o shard i de N (partição pelo hash da URL canônica)")
+    parser.add_argument('--discover-only', metavar='ARQUIVO',
+                        help="só descobre as páginas e grava a lista (para os shards usarem com --urls)")
+    parser.add_argument('--launch-shards', type=int, metavar='N',
+                        help="roda N shards em processos locais e combina os resultados")
+    parser.add_argument('--merge', nargs='+', metavar='SHARD_DIR',
+                        help="combina os diretórios de resultados dos shards num único relatório")
+    parser.add_argument('--resume', metavar='RESULTS_DIR',
+                        help="retoma uma execução interrompida a partir do diário no diretório de resultados")
+    parser.add_argument('--fingerprint', action='store_true',
+                        help="compara a impressão digital do DOM/CSS antes do screenshot e pula pares idênticos")
+    parser.add_argument('--fingerprint-mask', action='append', metavar='SELETOR',
+                        help="seletor CSS extra de nós dinâmicos ignorados na impressão digital (repetível)")
+    parser.add_argument('--profile-diff', choices=('cprofile', 'tracemalloc'),
+                        help="perfila cada diff (CPU com cProfile ou memória com tracemalloc) em <resultados>/profiles")
+    return parser
 
-        with open(report_path, 'w', encoding='utf-8') as f:
-            f.write(html_content)
 
 def get_user_input():
     """Solicita os domínios do usuário com validação"""
+    from prompt_toolkit import prompt
+    
     print("🌐 CONFIGURAÇÃO DOS DOMÍNIOS")
     print("=" * 50)
     
@@ -478,6 +3701,8 @@ def get_user_input():
                 
 def get_max_pages():
     """Solicita número máximo de páginas"""
+    from prompt_toolkit import prompt
+    
     while True:
         try:
             max_pages = prompt("\n📄 Quantas páginas deseja comparar? (padrão: 20): ").strip()
@@ -499,8 +3724,27 @@ def get_max_pages():
         except ValueError:
             print("❌ Por favor, digite um número válido!")
 
-# Uso da aplicação
-if __name__ == "__main__":
+def get_workers():
+    """Solicita número de workers paralelos"""
+    from prompt_toolkit import prompt
+    
+    while True:
+        try:
+            workers = prompt("\n⚙️  Quantas páginas capturar em paralelo? (padrão: 4): ").strip()
+            if not workers:
+                return 4
+            
+            workers = int(workers)
+            if workers <= 0:
+                print("❌ Número deve ser maior que zero!")
+                continue
+            
+            return workers
+            
+        except ValueError:
+            print("❌ Por favor, digite um número válido!")
+
+def run_interactive(args):
     print("=" * 60)
     print("🔥 COMPARADOR VISUAL EM MASSA")
     print("=" * 60)
@@ -509,13 +3753,16 @@ if __name__ == "__main__":
         # Solicita dados do usuário
         prod_domain, hml_domain = get_user_input()
         max_pages = get_max_pages()
+        workers = get_workers()
         
         print(f"\n🚀 Iniciando comparação...")
         print(f"   📊 Máximo de páginas: {max_pages}")
-        print(f"   ⏱️  Tempo estimado: {max_pages * 0.5:.1f} minutos")
+        print(f"   ⚙️  Workers: {workers}")
+        print(f"   ⏱️  Tempo estimado: {max_pages * 0.5 / workers:.1f} minutos")
         
         # Executa comparação
-        comparator = BulkVisualComparator(prod_domain, hml_domain, max_pages)
+        comparator = BulkVisualComparator(prod_domain, hml_domain, max_pages, workers=workers,
+                                          profile_diff=args.profile_diff)
         comparator.run_comparison()
         
     except KeyboardInterrupt:
@@ -523,4 +3770,30 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"\n❌ Erro geral: {e}")
         
-    print("\n" + "=" * 60)
\ No newline at end of file
+    print("\n" + "=" * 60)
+    return 0
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = build_arg_parser().parse_args(argv)
+    if not (args.prod or args.hml or args.config or args.resume or args.merge):
+        return run_interactive(args)
+    
+    try:
+        if args.merge:
+            return run_merge(args)
+        if args.launch_shards:
+            return launch_shards(args, argv)
+        return run_batch(args)
+    except KeyboardInterrupt:
+        print("\n⏹️ Processo interrompido pelo usuário")
+        return 130
+    except Exception as e:
+        print(f"\n❌ Erro geral: {e}")
+        return 3
+
+
+# Uso da aplicação
+if __name__ == "__main__":
+    sys.exit(main())